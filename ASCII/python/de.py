@@ -4,12 +4,35 @@
 #Greg Miller (gmiller@gregmiller.net) 2019
 #Released as public domain
 
-#TODO:
-#Determine which file JD falls in
-#Load proper file
+#Coefficients are held as 64 bit floats by default.  Pass decimal=True to
+#DE() to load and evaluate them as Decimal instead (much slower).
+#
+#Julian dates can be given as one number, or as a tuple of two numbers
+#whose sum is the date, e.g. (2451545.0,0.123456789), to keep the precision
+#of the fraction of the day.
+#
+#The first time an ASCII file is loaded (in float mode) its coefficients are
+#also saved as raw doubles in a checksummed file next to it, with ".f64"
+#appended to the name.  Later loads memory map that file instead of parsing
+#the text again.  It is rebuilt whenever the ASCII file's size or time stamp
+#changes, and can be deleted at any time.
+#
+#The ASCII files for a JD are found through an index of the start JD of every
+#asc*.NNN file in the directory, built on first use.  Several loaded files
+#are kept (least recently used first out) up to maxLoadedBytes.
+
 import re
+import bisect
+import glob
+import collections
 from decimal import Decimal
 import math
+import array
+import os
+import sys
+import mmap
+import struct
+import zlib
 
 class JPLSeries:
 	def __init__(self,seriesName,seriesOffset,numberOfProperties,numberOfCoefficients,numberOfSubIntervals):
@@ -20,66 +43,76 @@ class JPLSeries:
 		self.numberOfSubIntervals=numberOfSubIntervals
 
 	def getAllPropertiesForSeries(self,JD,coefficients,blockOffset):
+		jd0,jd1=DE.splitJD(JD)
 		startJD=coefficients[0+blockOffset]
 		endJD=coefficients[1+blockOffset]
 		blockDuration=endJD-startJD
 		subintervalDuration=blockDuration/self.numberOfSubIntervals
 		subintervalSize=self.numberOfCoefficients*self.numberOfProperties
-		subintervalNumber=math.floor((JD-startJD)/subintervalDuration)
+		subintervalNumber=math.floor(((jd0-startJD)+jd1)/subintervalDuration)
 		subintervalStart=subintervalDuration*subintervalNumber
 		subintervalEnd=subintervalDuration*subintervalNumber+subintervalDuration
 
 		#Normalize time variable (x) to be in the range -1 to 1 over the given subinterval
-		#If using two doubles for JD, this is where the two parts should be combined:
-		#e.g. jd=(JD[0]-(startJD+subintervalStart))+JD[1]
-		jd=JD-(startJD+subintervalStart)
+		#For a two part JD, the large part is reduced before adding the fraction
+		jd=(jd0-(startJD+subintervalStart))+jd1
 		x=(jd/subintervalDuration)*2-1
 
+		#The basis only depends on x, so it is shared by all properties
+		t,v=JPLSeries.chebyshevBasis(x,self.numberOfCoefficients)
 		properties=[0,0,0,0,0,0]
-		for i in range(self.numberOfProperties):
-			offset=blockOffset+self.offset+i*self.numberOfCoefficients+subintervalSize*subintervalNumber
-			t=self.computePropertyForSeries(x,coefficients,offset)
-			properties[i]=t[0]
-
-			velocity = t[1]
-			velocity=velocity*(Decimal(2.0)*self.numberOfSubIntervals/blockDuration)
-			properties[i+self.numberOfProperties]=velocity
+		offset=blockOffset+self.offset+subintervalSize*subintervalNumber
+		velocityScale=2*self.numberOfSubIntervals/blockDuration
+		JPLSeries.evaluateProperties(coefficients,offset,self.numberOfCoefficients,self.numberOfProperties,t,v,velocityScale,properties)
 		return properties
 
 	def computePropertyForSeries(self,x,coefficients,offset):
-		c=[]
-		for i in range(self.numberOfCoefficients):
-			c.append(coefficients[offset+i])
-		p=self.computePolynomial(x,c)
+		t,v=JPLSeries.chebyshevBasis(x,self.numberOfCoefficients)
+		p=[0,0]
+		JPLSeries.evaluateProperties(coefficients,offset,self.numberOfCoefficients,1,t,v,1,p)
 		return p
 
 	def computePolynomial(self,x,coefficients):
-		#Equation 14.20 from Explanetory Supplement 3rd ed.
-		t=[1,x]
+		t,v=JPLSeries.chebyshevBasis(x,len(coefficients))
+		p=[0,0]
+		JPLSeries.evaluateProperties(coefficients,0,len(coefficients),1,t,v,1,p)
+		return p
 
-		for n in range(2,len(coefficients)):
-			tn=2*x*t[n-1]-t[n-2]
-			t.append(tn)
+	#Same evaluation core as JPLDE.chebyshevBasis/evaluateComponents in Binary/Python
+	@staticmethod
+	def chebyshevBasis(x,count):
+		#Equation 14.20 from Explanetory Supplement 3rd ed.
+		#t holds T_n(x), v holds its derivative (for the velocity)
+		t=[0]*count
+		v=[0]*count
+		t[0]=1
+		if(count>1):
+			t[1]=x
+			v[1]=1
+		for n in range(2,count):
+			t[n]=2*x*t[n-1]-t[n-2]
+			v[n]=2*x*v[n-1]+2*t[n-1]-v[n-2]
+		return t,v
 
-		#Multiply the polynomial by the coefficients.
+	@staticmethod
+	def evaluateProperties(coefficients,offset,ccount,varCount,t,v,velocityScale,properties):
+		#Position and velocity of each of the varCount properties stored one
+		#after the other starting at coefficients[offset], written to
+		#properties[0:varCount] and properties[varCount:2*varCount].
 		#Loop through coefficients backwards (from smallest to largest) to avoid floating point rounding errors
-		position=0
-		for i in range(len(coefficients)-1,-1,-1):
-			position+=coefficients[i]*t[i]
-
-		#Compute velocity (just the derivitave of the above)
-		v=[0,1,4*x]
-		for n in range(3,len(coefficients)):
-			v.append(2*x*v[n-1]+2*t[n-1]-v[n-2])
-
-		velocity=0
-		for i in range(len(coefficients)-1,-1,-1):
-			velocity+=v[i]*coefficients[i]
-
-		return [position,velocity]
+		for i in range(varCount):
+			start=offset+i*ccount
+			position=0
+			velocity=0
+			for n in range(ccount-1,-1,-1):
+				c=coefficients[start+n]
+				position+=c*t[n]
+				velocity+=c*v[n]
+			properties[i]=position
+			properties[i+varCount]=velocity*velocityScale
 
 class DE:
-	def __init__(self,data):
+	def __init__(self,data,decimal=False):
 		#First three variables (after "name") are from "GROUP 1030" in header file
 		#Last variable is NCOEFF from first line of header file
 		self.name=data[0]
@@ -112,59 +145,173 @@ class DE:
 
 		self.series=series
 		self.loadedFile=""
+		self.decimal=decimal
+		self.fileIndex=None
+		self.loadedFiles=collections.OrderedDict()
+		self.loadedBytes=0
+		self.maxLoadedBytes=256*1024*1024
 
 	def loadFile(self,filename):
 		if(self.loadedFile==filename):
 			return
-		
-		print(f"Loading: {filename}")
 
-		self.coefficients=[]
-		f=open("de"+self.name+"/"+filename,"r")
+		loaded=self.loadedFiles.get(filename)
+		if(loaded is None):
+			path="de"+self.name+"/"+filename
+			if(self.decimal):
+				coefficients=DE.parseCoefficientsDecimal(path)
+				#A Decimal plus its list entry
+				size=len(coefficients)*(sys.getsizeof(Decimal(0))+8)
+			else:
+				coefficients=DE.loadCoefficientCache(path)
+				if(coefficients is None):
+					coefficients=DE.parseCoefficients(path)
+					DE.saveCoefficientCache(path,coefficients)
+				size=len(coefficients)*8
+			loaded=(coefficients,size)
+			self.loadedFiles[filename]=loaded
+			self.loadedBytes+=size
+			#Always keep the file just loaded, even if it is over the budget
+			while(len(self.loadedFiles)>1 and self.loadedBytes>self.maxLoadedBytes):
+				self.loadedBytes-=self.loadedFiles.popitem(last=False)[1][1]
+		else:
+			self.loadedFiles.move_to_end(filename)
+
+		self.coefficients=loaded[0]
+		self.loadedFile=filename
+		self.chunkStart=self.coefficients[0]
+
+		self.chunkEnd=self.coefficients[len(self.coefficients)-self.coefficientsPerBlock+1]
+
+	@staticmethod
+	def parseCoefficientsDecimal(path):
+		coefficients=[]
+		f=open(path,"r")
 		for l in f:
 			if(len(l) >17 and l[17:18]!=" "):
-				#print(l)
 				t=re.split(" +",l);
 				for i in range(1,4):
 					if(i>len(t)-1):
-						self.coefficients.append(Decimal("0.0"));
+						coefficients.append(Decimal("0.0"));
 					else:
-						self.coefficients.append(Decimal(t[i].replace("D","e")));
+						coefficients.append(Decimal(t[i].replace("D","e")));
 		f.close()
-		self.loadedFile=filename
-		self.chunkStart=self.coefficients[0]
-
-		self.chunkEnd=self.coefficients[len(self.coefficients)-self.coefficientsPerBlock+1]
-
-	def loadFileForJD(self,jd):
-		year=DE.julainDateToGregorian(jd)[0]
+		return coefficients
 
-		pm="p"
-		if(year<0):
-			year=abs(year)
-			pm="m"
+	@staticmethod
+	def parseCoefficients(path):
+		#Whole file at once: Fortran "D" exponents become "E" in one pass,
+		#then every coefficient line is split and converted in bulk.
+		f=open(path,"rb")
+		lines=f.read().replace(b"D",b"E").splitlines()
+		f.close()
+		lines=[l for l in lines if len(l)>17 and l[17:18]!=b" "]
+		values=b" ".join(lines).split()
+		if(len(values)!=3*len(lines)):
+			#Some line is short, pad each line to three values like the
+			#line by line parser does
+			values=[]
+			for l in lines:
+				t=l.split()
+				values+=t+[b"0.0"]*(3-len(t))
+		return array.array("d",map(float,values))
+
+	#Sidecar file: magic, source size, source mtime (ns), count, crc32 of the
+	#data, padded to 64 bytes, then the coefficients as native doubles
+	cacheMagic=b"DECOEF"+(b"LE" if sys.byteorder=="little" else b"BE")
+	cacheHeader=struct.Struct("<8sQqQI")
+	cacheHeaderSize=64
 
-		year=math.floor((year-self.fileBase)/self.yearsPerFile)*self.yearsPerFile+self.fileBase
+	@staticmethod
+	def loadCoefficientCache(path):
+		try:
+			st=os.stat(path)
+			f=open(path+".f64","rb")
+		except OSError:
+			return None
+		with f:
+			try:
+				m=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+			except ValueError:
+				return None
+
+		if(len(m)<DE.cacheHeaderSize):
+			m.close()
+			return None
+		magic,size,mtime,count,crc=DE.cacheHeader.unpack_from(m,0)
+		data=memoryview(m)[DE.cacheHeaderSize:]
+		if(magic!=DE.cacheMagic or size!=st.st_size or mtime!=st.st_mtime_ns or len(data)!=count*8 or zlib.crc32(data)!=crc):
+			data.release()
+			m.close()
+			return None
+		return data.cast("d")
 
-		print(f"{year} {self.fileBase} {self.yearsPerFile}")
+	@staticmethod
+	def saveCoefficientCache(path,coefficients):
+		try:
+			st=os.stat(path)
+			data=coefficients.tobytes()
+			header=DE.cacheHeader.pack(DE.cacheMagic,st.st_size,st.st_mtime_ns,len(coefficients),zlib.crc32(data))
+			temp=path+".f64.tmp"
+			f=open(temp,"wb")
+			f.write(header.ljust(DE.cacheHeaderSize,b"\0"))
+			f.write(data)
+			f.close()
+			os.replace(temp,path+".f64")
+		except OSError:
+			#No cache for read only directories, the ASCII file still works
+			pass
 
-		fileName=("asc"+pm+"{:0>"+str(self.fileNamePad)+"d}."+self.name).format(year)
-		neededFile=fileName
-		self.loadFile(neededFile)
+	def loadFileForJD(self,jd):
+		if(self.loadedFile!="" and jd>=self.chunkStart and jd<self.chunkEnd):
+			return
+		if(self.fileIndex is None):
+			self.buildFileIndex()
+
+		#Files overlap by a block, the later one wins
+		i=bisect.bisect_right(self.fileIndex[0],jd)-1
+		if(i<0):
+			raise FileNotFoundError(f"No ASCII file in de{self.name} covers JD {jd}")
+		self.loadFile(self.fileIndex[1][i])
+
+	def buildFileIndex(self):
+		#Start JD and name of every ASCII file, sorted by start JD
+		files=[]
+		for path in glob.glob(os.path.join("de"+self.name,"asc*."+self.name)):
+			f=open(path,"r")
+			f.readline()
+			start=float(f.readline().split()[0].replace("D","E"))
+			f.close()
+			files.append((start,os.path.basename(path)))
+		files.sort()
+		self.fileIndex=([f[0] for f in files],[f[1] for f in files])
 
 	def getAllPropertiesForSeries(self,series,JD):
-		self.loadFileForJD(JD)
+		jd0,jd1=DE.splitJD(JD)
+		self.loadFileForJD(jd0+jd1)
 
-		blockNumber=math.floor((JD-self.chunkStart)/self.daysPerBlock)
+		blockNumber=math.floor(((jd0-self.chunkStart)+jd1)/self.daysPerBlock)
 		blockOffset=blockNumber*(self.coefficientsPerBlock)
+		if(blockOffset+self.coefficientsPerBlock>len(self.coefficients)):
+			#Past the end of the last file, or in a gap between files
+			raise FileNotFoundError(f"No ASCII file in de{self.name} covers JD {jd0+jd1}")
 		return self.series[series].getAllPropertiesForSeries(JD,self.coefficients,blockOffset)
 
+	@staticmethod
+	def splitJD(JD):
+		#Two part JDs are (tuple or list) pairs, a plain JD has no second part
+		if(isinstance(JD,(tuple,list))):
+			return JD[0],JD[1]
+		return JD,0
+
 	@staticmethod
 	def getEarthPositionFromEMB(emb,moon):
-		earthMoonRatio=Decimal(0.813005600000000044E+02)
+		earthMoonRatio=0.813005600000000044E+02
+		if(isinstance(moon[0],Decimal)):
+			earthMoonRatio=Decimal(earthMoonRatio)
 		earth=[0,0,0,0,0,0]
 		for i in range(6):
-			earth[i]=emb[i]-moon[i]/(Decimal(1)+earthMoonRatio)
+			earth[i]=emb[i]-moon[i]/(1+earthMoonRatio)
 		return earth
 	
 	@staticmethod
@@ -174,7 +321,10 @@ class DE:
 	#From Meeus, CH7
 	@staticmethod
 	def julainDateToGregorian(jd):
-		temp=jd+Decimal(.5)
+		half=.5
+		if(isinstance(jd,Decimal)):
+			half=Decimal(half)
+		temp=jd+half
 		Z=math.trunc(temp)
 		F=temp-Z
 		A=Z
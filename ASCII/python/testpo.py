@@ -9,11 +9,11 @@ import math
 from de import *
 import decimal
 
-au=Decimal(0.149597870691000015E+09)
+au=0.149597870691000015E+09
 map=[0,0,1,13,3,4,5,6,7,8,9,10,12,2,11,12,0,14]
 
 def get(series,jd,x):
-	jd=Decimal(jd)
+	jd=float(jd)
 	if(series==12 or series==0):
 		return 0
 
@@ -39,7 +39,7 @@ def get(series,jd,x):
 	return b[x-1]
 
 def testpo(deNumber,year,month,day,jd,t,c,x,expectedValue):
-	expectedValue=Decimal(expectedValue)
+	expectedValue=float(expectedValue)
 
 	t1=get(t,jd,x)
 	t2=get(c,jd,x)
@@ -69,12 +69,12 @@ def parseTestCase(s):
 	year=int(s[4:9])
 	month=int(s[10:12])
 	day=int(s[13:15])
-	jd=Decimal(s[15:25])
+	jd=float(s[15:25])
 	t=int(s[25:28])
 	c=int(s[28:31])
 	x=int(s[31:34])
 
-	v=Decimal(s[34:57])
+	v=float(s[34:57])
 	#print(f"{de} {year} {month} {day} {jd} {t} {c} {x} {v}")
 	try:
 		testpo(de, year, month, day, jd, t, c, x, v)
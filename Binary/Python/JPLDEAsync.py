@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# asyncio interface to a JPLDE file.
+#
+# Block reads run in an executor so the event loop never waits on the disk,
+# concurrent requests for the same block share a single read, and loaded
+# blocks go into the JPLDE object's block cache where the synchronous API
+# sees them too.  Batches run entirely in the executor and read the file
+# directly, like JPLDE.getStates(), leaving the block cache alone.
+#
+# Example:
+#
+# de=AsyncJPLDE(JPLDE("jpleph.405"))
+# venus=await de.getState(1,2451545.0)
+# states=await de.getStates([0,1,2],numpy.arange(2451545.0,2451555.0,0.5))
+
+import asyncio
+import mmap
+import time
+from JPLDE import *
+
+class AsyncJPLDE:
+    def __init__(self,de,executor=None):
+        self.de=de
+        self.executor=executor
+        #Block number -> future of a read in progress
+        self.pending={}
+
+    async def getBlock(self,blockNum):
+        de=self.de
+        block=de.cache.get((de.cacheKey,blockNum))
+        if(block is not None):
+            return block
+
+        future=self.pending.get(blockNum)
+        if(future is None):
+            loop=asyncio.get_running_loop()
+            future=loop.run_in_executor(self.executor,self.readBlock,blockNum)
+            self.pending[blockNum]=future
+            future.add_done_callback(lambda f: self.pending.pop(blockNum,None))
+        #Shielded so a cancelled caller doesn't cancel the read for the others
+        return await asyncio.shield(future)
+
+    def readBlock(self,blockNum):
+        #Runs in the executor.  The block is a view of the memory mapped file,
+        #touch every page so the disk read happens here rather than when the
+        #event loop first uses the coefficients.
+        de=self.de
+        start=time.perf_counter()
+        block=de.getBlock(blockNum)
+        step=mmap.PAGESIZE//8
+        for i in range(0,len(block),step):
+            block[i]
+        de.cache.put((de.cacheKey,blockNum),block,de.blockSize)
+        stats=de.stats
+        if(stats is not None):
+            stats.blockLoaded(blockNum,de.blockSize,time.perf_counter()-start)
+        return block
+
+    async def getBlockForJD(self,jd):
+        return await self.getBlock(self.de.getBlockNumber(jd))
+
+    async def getState(self,body,jd):
+        block=await self.getBlockForJD(jd)
+        return self.de.computeBody(body,jd,block)
+
+    async def getStates(self,bodies,jds):
+        #Async form of JPLDE.getStates(), the reads (page faults on the
+        #mapping) and the evaluation both happen in the executor
+        JPLDE.requireNumpy()
+        loop=asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,self.de.getStates,bodies,jds)
+
+    async def getPlanetBatch(self,body,jds):
+        return (await self.getStates([body],jds))[0]
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+# Routes queries across a directory of binary JPL DE files.
+#
+# The catalog reads the header of every jpleph* file in the directory and
+# indexes which file covers which JDs.  Where files overlap (e.g.
+# jpleph2000-2040.405 next to a full jpleph.405) the one covering the longer
+# range is used, so a batch touches as few files as possible.  Files are only
+# opened when a query needs them, and at most maxOpen of them are kept open.
+#
+# Files of several DE versions can live in the same directory, the catalog
+# uses one of them: the version asked for, or the highest one found.
+#
+# Example:
+#
+# catalog=JPLDECatalog("E:\\Astronomy\\_Ephemeris\\JPLDEBinaries",405)
+# venus=catalog.getPlanet(1,2451545.0)
+# states=catalog.getStates([0,1,2],numpy.arange(2400000.5,2500000.5,10))
+
+import os
+import glob
+import bisect
+import threading
+import collections
+from JPLDE import *
+
+class JPLDECatalog:
+    def __init__(self,path,version=None,pattern="jpleph*",maxOpen=8,cache=None):
+        self.path=path
+        self.maxOpen=maxOpen
+        #Shared by every file opened through the catalog
+        if(cache is None):
+            cache=JPLDEBlockCache()
+        self.cache=cache
+        self.lock=threading.Lock()
+        #File index -> open JPLDE, least recently used first
+        self.open=collections.OrderedDict()
+
+        #(start JD, end JD, DE version, file name) of every readable file
+        files=[]
+        for filename in sorted(glob.glob(os.path.join(path,pattern))):
+            try:
+                h=JPLDEHeader.load(filename)
+                blockCount=os.path.getsize(filename)//h.blockSize-2
+            except (OSError,ValueError,TypeError,ZeroDivisionError,struct.error):
+                continue
+            if(blockCount<=0):
+                continue
+            #The header's jdEnd isn't always right for truncated files
+            jdEnd=min(h.jdEnd,h.jdStart+blockCount*h.jdStep)
+            files.append((h.jdStart,jdEnd,h.version,filename))
+
+        self.versions=sorted(set(f[2] for f in files))
+        if(version is None and len(self.versions)>0):
+            version=self.versions[-1]
+        self.version=version
+        #Longest coverage first, that's the order files are preferred in
+        self.files=sorted([f for f in files if f[2]==version],key=lambda f:(f[0]-f[1],f[3]))
+        if(len(self.files)==0):
+            raise ValueError(f"No DE{version if version is not None else ''} files matching {pattern} in {path}")
+        self.buildSegments()
+
+    def buildSegments(self):
+        #Splits the covered JDs into segments each served by one file:
+        #segmentStarts[i]..segmentEnds[i] comes from self.files[segmentFiles[i]]
+        bounds=sorted(set([f[0] for f in self.files]+[f[1] for f in self.files]))
+        self.segmentStarts=[]
+        self.segmentEnds=[]
+        self.segmentFiles=[]
+        for i in range(len(bounds)-1):
+            start=bounds[i]
+            end=bounds[i+1]
+            covering=[n for n in range(len(self.files)) if self.files[n][0]<=start and self.files[n][1]>=end]
+            if(len(covering)==0):
+                continue
+            if(len(self.segmentFiles)>0 and self.segmentFiles[-1]==covering[0] and self.segmentEnds[-1]==start):
+                self.segmentEnds[-1]=end
+                continue
+            self.segmentStarts.append(start)
+            self.segmentEnds.append(end)
+            self.segmentFiles.append(covering[0])
+
+    def getCoverage(self):
+        #(start JD, end JD, file name) of each segment, in JD order
+        return [(self.segmentStarts[i],self.segmentEnds[i],self.files[self.segmentFiles[i]][3]) for i in range(len(self.segmentFiles))]
+
+    def getVersions(self):
+        #Every DE version found in the directory
+        return self.versions
+
+    def getFile(self,index):
+        #JPLDE for self.files[index], opened on first use
+        with self.lock:
+            de=self.open.get(index)
+            if(de is not None):
+                self.open.move_to_end(index)
+                return de
+        de=JPLDE(self.files[index][3],self.cache)
+        with self.lock:
+            if(index in self.open):
+                return self.open[index]
+            self.open[index]=de
+            while(len(self.open)>self.maxOpen):
+                #Not closed here, another thread may still be using it.  The
+                #file is released once the last reference is gone.
+                self.open.popitem(last=False)
+        return de
+
+    def getSegment(self,jd):
+        i=bisect.bisect_right(self.segmentStarts,jd)-1
+        if(i<0 or jd>self.segmentEnds[i]):
+            raise ValueError(f"JD {jd} is not covered by any DE{self.version} file in {self.path}")
+        return i
+
+    def getFileForJD(self,jd):
+        return self.getFile(self.segmentFiles[self.getSegment(jd)])
+
+    def getPlanet(self,planet,jd):
+        return self.getFileForJD(jd).getPlanet(planet,jd)
+
+    def getAllBodies(self,jd):
+        return self.getFileForJD(jd).getAllBodies(jd)
+
+    def relativeState(self,target,center,jds):
+        if(numpy is None or numpy.ndim(jds)==0):
+            return self.getFileForJD(jds).relativeState(target,center,jds)
+
+        jds=numpy.asarray(jds,dtype=numpy.float64)
+        states=numpy.zeros((jds.size,6))
+        flat=jds.ravel()
+        for de,indices in self.routeBatch(flat):
+            states[indices]=de.relativeState(target,center,flat[indices])
+        return states.reshape(jds.shape+(6,))
+
+    def getPlanetBatch(self,planet,jds):
+        return self.getStates([planet],jds)[0]
+
+    def getStates(self,planets,jds):
+        #JPLDE.getStates() with each epoch evaluated by the file covering it
+        JPLDE.requireNumpy()
+        jds=numpy.asarray(jds,dtype=numpy.float64)
+        states=numpy.zeros((len(planets),jds.size,6))
+        flat=jds.ravel()
+        for de,indices in self.routeBatch(flat):
+            states[:,indices]=de.getStates(planets,flat[indices])
+        return states.reshape((len(planets),)+jds.shape+(6,))
+
+    def routeBatch(self,jds):
+        #Splits an array of JDs by file, returns [(JPLDE, indices into jds)]
+        JPLDE.requireNumpy()
+        segments=numpy.searchsorted(self.segmentStarts,jds,side="right")-1
+        uncovered=(segments<0)|(jds>numpy.array(self.segmentEnds)[numpy.maximum(segments,0)])
+        if(numpy.any(uncovered)):
+            missing=jds[uncovered]
+            raise ValueError(f"{len(missing)} JDs are not covered by any DE{self.version} file in {self.path} (first is {missing[0]})")
+
+        fileIndex=numpy.array(self.segmentFiles)[segments]
+        return [(self.getFile(int(f)),numpy.flatnonzero(fileIndex==f)) for f in numpy.unique(fileIndex)]
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+# Memoized state vectors for services that ask for the same bodies at the
+# same epochs over and over.
+#
+# MemoJPLDE wraps a JPLDE object.  getPlanet(), getPlanetBatch() and
+# getStates() (including the derived bodies 15 and 16) remember every state
+# they compute, keyed on (file, body, exact JD), and return the stored state
+# when the same query comes again.  Everything else is passed through to the
+# wrapped object.  Scalar and batch calls share the stored states, so like
+# JPLDE's own scalar and batch methods they can differ in the last bit.
+#
+# The results are kept in a JPLDEMemoCache, bounded by number of entries
+# and optionally by age.  One cache can be shared by several MemoJPLDE
+# objects, and rewriting a file gives it a new key so old results are never
+# returned for it.
+#
+# Example:
+#
+# memo=JPLDEMemoCache(maxEntries=100000,ttl=60)
+# de=MemoJPLDE(JPLDE("jpleph.405"),memo)
+# moon=de.getPlanet(9,2451545.0)
+# print(memo.getStats()["hitRate"])
+
+import time
+import threading
+import collections
+from JPLDE import *
+
+class JPLDEMemoCache:
+    def __init__(self,maxEntries=65536,ttl=None):
+        #ttl is the age in seconds after which a state is computed again,
+        #None keeps them until they're evicted
+        self.maxEntries=maxEntries
+        self.ttl=ttl
+        self.lock=threading.Lock()
+        #key -> (expiry time, state)
+        self.entries=collections.OrderedDict()
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+        self.expirations=0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self,key):
+        return self.getMany([key])[0]
+
+    def getMany(self,keys):
+        #Stored states for each key, None where there isn't one
+        now=time.monotonic()
+        values=[]
+        with self.lock:
+            for key in keys:
+                entry=self.entries.get(key)
+                if(entry is not None and entry[0] is not None and entry[0]<=now):
+                    del self.entries[key]
+                    self.expirations+=1
+                    entry=None
+                if(entry is None):
+                    self.misses+=1
+                    values.append(None)
+                else:
+                    self.hits+=1
+                    self.entries.move_to_end(key)
+                    values.append(entry[1])
+        return values
+
+    def put(self,key,state):
+        self.putMany([(key,state)])
+
+    def putMany(self,items):
+        expiry=None
+        if(self.ttl is not None):
+            expiry=time.monotonic()+self.ttl
+        with self.lock:
+            for key,state in items:
+                self.entries[key]=(expiry,state)
+                self.entries.move_to_end(key)
+            while(len(self.entries)>self.maxEntries):
+                self.entries.popitem(last=False)
+                self.evictions+=1
+
+    def invalidate(self,fileKey=None):
+        #Forgets the states of one file (a JPLDE cacheKey), or everything
+        with self.lock:
+            if(fileKey is None):
+                self.entries.clear()
+                return
+            for key in [k for k in self.entries if k[0]==fileKey]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits=0
+            self.misses=0
+            self.evictions=0
+            self.expirations=0
+
+    def getStats(self):
+        with self.lock:
+            lookups=self.hits+self.misses
+            return {
+                "entries":len(self.entries),
+                "hits":self.hits,
+                "misses":self.misses,
+                "evictions":self.evictions,
+                "expirations":self.expirations,
+                "hitRate":self.hits/lookups if lookups>0 else 0.0
+            }
+
+class MemoJPLDE:
+    def __init__(self,de,memo=None):
+        self.de=de
+        if(memo is None):
+            memo=JPLDEMemoCache()
+        self.memo=memo
+
+    def __getattr__(self,name):
+        return getattr(self.de,name)
+
+    def invalidate(self):
+        #Forgets every state remembered for this file
+        self.memo.invalidate(self.de.cacheKey)
+
+    def getPlanet(self,planet,jd):
+        key=(self.de.cacheKey,planet,jd)
+        state=self.memo.get(key)
+        if(state is None):
+            state=tuple(self.de.getPlanet(planet,jd))
+            self.memo.put(key,state)
+        return list(state)
+
+    def getPlanetBatch(self,planet,jds):
+        return self.getStates([planet],jds)[0]
+
+    def getStates(self,planets,jds):
+        #Same result as JPLDE.getStates(), only the epochs that aren't all
+        #remembered for every planet are evaluated.  Meant for small,
+        #repetitive batches, each epoch costs a few dictionary lookups.
+        JPLDE.requireNumpy()
+        planets=list(planets)
+        jds=numpy.asarray(jds,dtype=numpy.float64)
+        unique,inverse=numpy.unique(jds.ravel(),return_inverse=True)
+        jdList=unique.tolist()
+        fileKey=self.de.cacheKey
+
+        keys=[(fileKey,p,jd) for jd in jdList for p in planets]
+        found=self.memo.getMany(keys)
+        values=numpy.empty((len(planets),len(unique),6))
+        missing=[]
+        for j in range(len(jdList)):
+            states=found[j*len(planets):(j+1)*len(planets)]
+            if(None in states):
+                missing.append(j)
+            else:
+                values[:,j]=states
+
+        if(len(missing)>0):
+            computed=self.de.getStates(planets,unique[missing])
+            values[:,missing]=computed
+            items=[]
+            for n in range(len(missing)):
+                jd=jdList[missing[n]]
+                for i in range(len(planets)):
+                    items.append(((fileKey,planets[i],jd),tuple(computed[i,n].tolist())))
+            self.memo.putMany(items)
+
+        return values[:,inverse.ravel()].reshape((len(planets),)+jds.shape+(6,))
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+# Evaluates large batches of epochs for a JPLDE file in a pool of processes.
+#
+# The epochs are split into chunks that don't cross block boundaries (unless
+# a single block holds far more than a chunk) and each worker evaluates its
+# chunks with JPLDE.getStates().  The input JDs and the output states live in
+# shared memory, so only the chunk boundaries are sent to the workers and the
+# results are never pickled.
+#
+# With the "fork" start method (the default on Linux) the workers inherit the
+# parent's JPLDE object, including its memory mapping of the file, so nothing
+# is reopened or parsed again.  With "spawn" each worker opens the file once.
+#
+# Example: (positions of all planets, every minute for a year)
+#
+# de=JPLDE("jpleph.405")
+# jds=numpy.arange(2451545.0,2451545.0+365,1/1440)
+# states=getStatesParallel(de,range(11),jds)
+
+import os
+import multiprocessing
+import numpy
+from JPLDE import *
+
+workerDE=None
+workerJDs=None
+workerStates=None
+
+def initWorker(source,jdsShared,statesShared,bodyCount):
+    global workerDE
+    global workerJDs
+    global workerStates
+
+    if(isinstance(source,JPLDE)):
+        workerDE=source
+        #The cache (and its lock) was copied in whatever state the parent
+        #left it, start with an empty one.
+        workerDE.cache=JPLDEBlockCache()
+    else:
+        workerDE=JPLDE(source)
+
+    workerJDs=numpy.frombuffer(jdsShared,dtype=numpy.float64)
+    workerStates=numpy.frombuffer(statesShared,dtype=numpy.float64).reshape(bodyCount,len(workerJDs),6)
+
+def evaluateChunk(args):
+    bodies,start,end=args
+    workerStates[:,start:end]=workerDE.getStates(bodies,workerJDs[start:end])
+
+def getChunks(de,jds,chunkCount):
+    #Splits sorted JDs into about chunkCount index ranges, moving each split
+    #to the next block boundary when one is close.
+    size=max(1,-(-len(jds)//chunkCount))
+    changes=numpy.flatnonzero(numpy.diff(de.getBlockNumbers(jds)))+1
+
+    chunks=[]
+    start=0
+    while(start<len(jds)):
+        end=min(start+size,len(jds))
+        if(end<len(jds)):
+            i=numpy.searchsorted(changes,end)
+            if(i<len(changes) and changes[i]-end<=size//2):
+                end=int(changes[i])
+        chunks.append((start,end))
+        start=end
+    return chunks
+
+def getStatesParallel(de,bodies,jds,processes=None,context=None):
+    #Same result as de.getStates(bodies,jds), computed by a pool of processes
+    bodies=list(bodies)
+    jds=numpy.asarray(jds,dtype=numpy.float64)
+    shape=jds.shape
+    jds=jds.ravel()
+    if(len(jds)==0):
+        return numpy.zeros((len(bodies),)+shape+(6,))
+
+    order=None
+    if(numpy.any(numpy.diff(jds)<0)):
+        order=numpy.argsort(jds,kind="stable")
+        jds=jds[order]
+
+    if(processes is None):
+        processes=os.cpu_count() or 1
+    if(context is None):
+        context=multiprocessing.get_context()
+
+    jdsShared=context.RawArray("d",len(jds))
+    numpy.frombuffer(jdsShared,dtype=numpy.float64)[:]=jds
+    statesShared=context.RawArray("d",len(bodies)*len(jds)*6)
+
+    source=de
+    if(context.get_start_method()!="fork"):
+        source=de.filename
+
+    chunks=getChunks(de,jds,processes*4)
+    with context.Pool(processes,initializer=initWorker,initargs=(source,jdsShared,statesShared,len(bodies))) as pool:
+        pool.map(evaluateChunk,[(bodies,start,end) for start,end in chunks])
+
+    states=numpy.frombuffer(statesShared,dtype=numpy.float64).reshape(len(bodies),len(jds),6)
+    if(order is None):
+        states=states.copy()
+    else:
+        unsorted=numpy.empty_like(states)
+        unsorted[:,order]=states
+        states=unsorted
+    return states.reshape((len(bodies),)+shape+(6,))
+
+def getStatesForRange(de,bodies,jdStart,jdEnd,jdStep,processes=None,context=None):
+    #States for every jdStep days from jdStart up to (not including) jdEnd
+    return getStatesParallel(de,bodies,numpy.arange(jdStart,jdEnd,jdStep),processes,context)
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+
+# Local HTTP server for state vectors from one or more JPLDE files.
+#
+# The files are opened once and stay open, so clients don't pay for parsing
+# the header or warming the block cache.  Requests arriving within a short
+# window are merged into one vectorized JPLDE.getStates() call per file and
+# body.
+#
+# Useage:
+# python JPLDEServer.py [-p port] [-w batch window ms] jpleph.405 [jpleph.430 ...]
+#
+# Requests: (file is the file name without the path, body is the JPLDE series number)
+# GET  /state?file=jpleph.405&body=1&jd=2451545.0,2451546.0
+# POST /state   {"file":"jpleph.405","body":1,"jd":[2451545.0,2451546.0]}
+# GET  /stats
+#
+# Both /state forms return {"states":[[x,y,z,vx,vy,vz],...]}, one row per jd.
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import argparse
+import collections
+import concurrent.futures
+import urllib.parse
+import http.server
+from JPLDE import *
+
+class JPLDEBatcher:
+    #Collects requests on a queue and evaluates them in batches on one thread
+    def __init__(self,files,window=0.002,maxBatch=1024):
+        self.files=files
+        self.window=window
+        self.maxBatch=maxBatch
+        self.queue=queue.Queue()
+        self.lock=threading.Lock()
+        self.started=time.time()
+        self.requests=0
+        self.epochs=0
+        self.batches=0
+        self.errors=0
+        self.latencies=collections.deque(maxlen=10000)
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def submit(self,file,body,jds):
+        future=concurrent.futures.Future()
+        self.queue.put((file,body,jds,future,time.perf_counter()))
+        return future
+
+    def run(self):
+        while(True):
+            batch=[self.queue.get()]
+            deadline=time.perf_counter()+self.window
+            while(len(batch)<self.maxBatch):
+                timeout=deadline-time.perf_counter()
+                if(timeout<=0):
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.evaluate(batch)
+
+    def evaluate(self,batch):
+        #Requests for the same body share a call, each body is only evaluated
+        #at the JDs asked for it
+        byBody=collections.defaultdict(list)
+        for request in batch:
+            byBody[(request[0],request[1])].append(request)
+
+        for (file,body),requests in byBody.items():
+            try:
+                de=self.files[file]
+                jds=numpy.concatenate([r[2] for r in requests])
+                states=de.getPlanetBatch(body,jds)
+            except Exception:
+                #Retry one at a time so a bad request doesn't fail the others
+                for r in requests:
+                    self.evaluateOne(r)
+                continue
+
+            start=0
+            for r in requests:
+                end=start+len(r[2])
+                self.finish(r,states[start:end])
+                start=end
+
+        with self.lock:
+            self.batches+=1
+
+    def evaluateOne(self,request):
+        try:
+            states=self.files[request[0]].getPlanetBatch(request[1],request[2])
+        except Exception as e:
+            with self.lock:
+                self.errors+=1
+            request[3].set_exception(e)
+            return
+        self.finish(request,states)
+
+    def finish(self,request,states):
+        latency=time.perf_counter()-request[4]
+        with self.lock:
+            self.requests+=1
+            self.epochs+=len(request[2])
+            self.latencies.append(latency)
+        request[3].set_result(states)
+
+    def getStats(self):
+        with self.lock:
+            elapsed=time.time()-self.started
+            latencies=sorted(self.latencies)
+            stats={
+                "uptime":elapsed,
+                "requests":self.requests,
+                "epochs":self.epochs,
+                "batches":self.batches,
+                "errors":self.errors,
+                "requestsPerSecond":self.requests/elapsed if elapsed>0 else 0.0,
+                "epochsPerSecond":self.epochs/elapsed if elapsed>0 else 0.0,
+                "meanBatchSize":self.requests/self.batches if self.batches>0 else 0.0
+            }
+        if(len(latencies)>0):
+            stats["latencyMean"]=sum(latencies)/len(latencies)
+            stats["latencyP50"]=latencies[len(latencies)//2]
+            stats["latencyP99"]=latencies[min(len(latencies)-1,int(len(latencies)*0.99))]
+        stats["files"]={name:de.cache.getStats() for name,de in self.files.items()}
+        return stats
+
+class JPLDERequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url=urllib.parse.urlparse(self.path)
+        if(url.path=="/stats"):
+            self.sendJSON(200,self.server.batcher.getStats())
+        elif(url.path=="/state"):
+            q=urllib.parse.parse_qs(url.query)
+            try:
+                jds=[float(jd) for v in q["jd"] for jd in v.split(",")]
+                self.answer(q["file"][0],int(q["body"][0]),jds)
+            except (KeyError,ValueError) as e:
+                self.sendJSON(400,{"error":f"Bad request: {e}"})
+        else:
+            self.sendJSON(404,{"error":"Unknown path"})
+
+    def do_POST(self):
+        if(urllib.parse.urlparse(self.path).path!="/state"):
+            self.sendJSON(404,{"error":"Unknown path"})
+            return
+        try:
+            request=json.loads(self.rfile.read(int(self.headers.get("Content-Length",0))))
+            jds=request["jd"]
+            if(not isinstance(jds,list)):
+                jds=[jds]
+            self.answer(request["file"],int(request["body"]),[float(jd) for jd in jds])
+        except (KeyError,ValueError,TypeError) as e:
+            self.sendJSON(400,{"error":f"Bad request: {e}"})
+
+    def answer(self,file,body,jds):
+        if(file not in self.server.batcher.files):
+            self.sendJSON(404,{"error":f"Unknown file: {file}"})
+            return
+        if(body<0 or body>=JPLDE.bodyCount):
+            self.sendJSON(400,{"error":f"Unknown body: {body}"})
+            return
+        try:
+            states=self.server.batcher.submit(file,body,numpy.array(jds)).result()
+        except (ValueError,IndexError) as e:
+            self.sendJSON(400,{"error":str(e)})
+            return
+        self.sendJSON(200,{"states":states.tolist()})
+
+    def sendJSON(self,status,data):
+        body=json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+class JPLDEServer(http.server.ThreadingHTTPServer):
+    daemon_threads=True
+
+    def __init__(self,filenames,host="127.0.0.1",port=8405,window=0.002):
+        files={}
+        for f in filenames:
+            files[os.path.basename(f)]=JPLDE(f)
+        self.batcher=JPLDEBatcher(files,window)
+        super().__init__((host,port),JPLDERequestHandler)
+
+def main(argv):
+    parser=argparse.ArgumentParser(description="Serves JPL DE state vectors over local HTTP.")
+    parser.add_argument("files",nargs="+",help="binary ephemeris files (jpleph.*)")
+    parser.add_argument("-p",type=int,default=8405,dest="port",help="port [Default 8405]")
+    parser.add_argument("-w",type=float,default=2.0,dest="window",help="batch window in ms [Default 2]")
+    args=parser.parse_args(argv)
+
+    server=JPLDEServer(args.files,port=args.port,window=args.window/1000)
+    print(f"Serving {', '.join(server.batcher.files)} on http://127.0.0.1:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__=="__main__":
+    main(sys.argv[1:])
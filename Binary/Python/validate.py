@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+# Checks binary JPL DE files against JPL's testpo.NNN test vectors.
+#
+# Does the same checks as testpo.py, but each test file is read into arrays
+# in one pass and the cases are evaluated with one JPLDE.relativeState() call
+# per (target, center) pair instead of scalar getPlanet() calls per case.
+# Versions are checked in a pool of processes.
+#
+# The result is a report for each version: number of cases passed, failed
+# and skipped (outside of the file's range, or needing a series the file
+# doesn't have), the largest error for every (target, center, component),
+# and the first failures.
+#
+# Useage:
+# python validate.py [-p path] [-j processes] [-o report.json] [version ...]
+#
+# path holds jpleph.NNN and testpo.NNN for each version, every version below
+# is checked if none are given.  The exit status is 1 if any case failed.
+
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+from JPLDE import *
+
+versions=["102","200","202","403","405","406","410","413","414","418","421","422","423","424","430","430t","431","432","432t","433","434","435","436","436t","438","438t","440","440t","441"]
+
+#Nutations, librations and TT-TDB aren't distances, they're not in AU
+notInAU=(14,15,17)
+
+def readTestFile(filename):
+    #Returns the cases after the EOT line as arrays: jd, target, center,
+    #component (1-6) and the expected value
+    f=open(filename,"r")
+    text=f.read()
+    f.close()
+
+    start=text.find("\nEOT")
+    if(start<0):
+        raise ValueError(f"No EOT line in {filename}")
+    lines=text[text.find("\n",start+1)+1:].splitlines()
+
+    #Everything after the date (columns 15 on) is whitespace separated numbers
+    values=" ".join([l[15:] for l in lines if len(l.strip())>0]).split()
+    if(len(values)%5!=0):
+        raise ValueError(f"Malformed test case in {filename}")
+    values=numpy.array(values,dtype=numpy.float64).reshape(-1,5)
+
+    return {
+        "jd":values[:,0].copy(),
+        "target":values[:,1].astype(numpy.intp),
+        "center":values[:,2].astype(numpy.intp),
+        "component":values[:,3].astype(numpy.intp),
+        "expected":values[:,4].copy()
+    }
+
+def getMissingBodies(de):
+    #testpo body numbers that need a series the file doesn't have
+    present=set(de.getSeriesPresent())
+    missing=[]
+    for i in range(len(JPLDE.testpoBodies)):
+        body=JPLDE.testpoBodies[i]
+        if(body is not None and not set(JPLDE.getSeriesForBody(body))<=present):
+            missing.append(i)
+    return missing
+
+def runTests(de,cases,tolerance=1.0E-8,maxFailures=20):
+    #Evaluates the cases read by readTestFile() with de, returns the report
+    jd=cases["jd"]
+    target=cases["target"]
+    center=cases["center"]
+    component=cases["component"]
+    expected=cases["expected"]
+
+    missing=getMissingBodies(de)
+    skipped=(jd<de.jdStart)|(jd>=de.jdEnd)|numpy.isin(target,missing)|numpy.isin(center,missing)
+    run=numpy.flatnonzero(~skipped)
+
+    values=numpy.full(len(jd),numpy.nan)
+    pairs=target[run]*100+center[run]
+    for pair in numpy.unique(pairs):
+        t=int(pair)//100
+        c=int(pair)%100
+        #In JD order, so cases sharing a block are evaluated together
+        indices=run[pairs==pair]
+        indices=indices[numpy.argsort(jd[indices],kind="stable")]
+        states=de.relativeState(t,c,jd[indices])
+        v=states[numpy.arange(len(indices)),component[indices]-1]
+        if(t not in notInAU):
+            v=v/de.header.au
+        values[indices]=v
+
+    errors=numpy.abs(values-expected)
+    failed=numpy.zeros(len(jd),dtype=bool)
+    failed[run]=~(errors[run]<=tolerance)
+
+    maxErrors=[]
+    keys=(target[run]*100+center[run])*10+component[run]
+    for key in numpy.unique(keys):
+        indices=run[keys==key]
+        e=errors[indices]
+        maxErrors.append({
+            "target":int(key)//1000,
+            "center":int(key)//10%100,
+            "component":int(key)%10,
+            "tests":len(indices),
+            "failed":int(numpy.count_nonzero(failed[indices])),
+            #nan (a case that couldn't be evaluated) is reported as None
+            "maxError":None if numpy.any(numpy.isnan(e)) else float(e.max())
+        })
+
+    failures=[]
+    for i in numpy.flatnonzero(failed)[:maxFailures]:
+        failures.append({
+            "jd":float(jd[i]),
+            "target":int(target[i]),
+            "center":int(center[i]),
+            "component":int(component[i]),
+            "expected":float(expected[i]),
+            "value":float(values[i]),
+            "error":float(errors[i])
+        })
+
+    return {
+        "tests":len(run),
+        "passed":len(run)-int(numpy.count_nonzero(failed)),
+        "failed":int(numpy.count_nonzero(failed)),
+        "skipped":int(numpy.count_nonzero(skipped)),
+        "missingBodies":missing,
+        "maxErrors":maxErrors,
+        "failures":failures
+    }
+
+def validateVersion(version,ephemerisFile,testFile,tolerance=1.0E-8,maxFailures=20):
+    #Runs in a worker process, returns the report for one version.  A missing
+    #or unreadable file gives a report with an "error" and no cases run.
+    started=time.perf_counter()
+    report={"version":version,"ephemeris":ephemerisFile,"testFile":testFile}
+    try:
+        cases=readTestFile(testFile)
+        de=JPLDE(ephemerisFile)
+        try:
+            report.update(runTests(de,cases,tolerance,maxFailures))
+        finally:
+            de.close()
+    except (OSError,ValueError) as e:
+        report["error"]=str(e)
+    report["seconds"]=time.perf_counter()-started
+    return report
+
+def validateVersions(path,versionList=versions,processes=None,tolerance=1.0E-8,maxFailures=20):
+    #Reports for jpleph.NNN against testpo.NNN in path for every version, in
+    #the order of versionList
+    JPLDE.requireNumpy()
+    if(processes is None):
+        processes=os.cpu_count() or 1
+    processes=max(1,min(processes,len(versionList)))
+
+    jobs=[(v,os.path.join(path,"jpleph."+v),os.path.join(path,"testpo."+v),tolerance,maxFailures) for v in versionList]
+    if(processes==1):
+        return [validateVersion(*j) for j in jobs]
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(validateVersion,*zip(*jobs)))
+
+def printReport(report):
+    print()
+    print(report["version"])
+    if("error" in report):
+        print(f"Skipped: {report['error']}")
+        return
+    for f in report["failures"]:
+        print(f"Fail: {f['jd']}\t{f['target']}\t{f['center']}\t{f['component']}\t{f['expected']}\t{f['value']}\tDiff={f['error']}")
+    if(report["failed"]>len(report["failures"])):
+        print(f"... {report['failed']-len(report['failures'])} more failures")
+    print(f"Tests ran:{report['tests']} Failed:{report['failed']} Skipped:{report['skipped']} ({report['seconds']:.2f} s)")
+
+def main(argv):
+    parser=argparse.ArgumentParser(description="Checks binary JPL DE files against JPL's testpo test vectors.")
+    parser.add_argument("versions",nargs="*",default=versions,help="DE versions to check [Default all]")
+    parser.add_argument("-p",default=".",dest="path",help="directory with jpleph.NNN and testpo.NNN [Default .]")
+    parser.add_argument("-j",type=int,default=None,dest="processes",help="number of processes [Default CPU count]")
+    parser.add_argument("-o",default=None,dest="output",help="write the report as JSON to this file")
+    parser.add_argument("-t",type=float,default=1.0E-8,dest="tolerance",help="largest error allowed [Default 1e-8]")
+    args=parser.parse_args(argv)
+
+    reports=validateVersions(args.path,args.versions,args.processes,args.tolerance)
+    for r in reports:
+        printReport(r)
+
+    if(args.output is not None):
+        f=open(args.output,"w")
+        json.dump({"tolerance":args.tolerance,"versions":reports},f,indent=1)
+        f.close()
+
+    return 1 if any(r.get("failed",0)>0 for r in reports) else 0
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -24,6 +24,23 @@
 # 12   phi,theta,psi    radians               Lunar mantle libration
 # 13   Ox,Oy,Oz         radians/day           Lunar mantle angular velocity
 # 14   t                seconds               TT-TDB (at geocenter)
+#
+# Derived bodies, accepted by getPlanet() and the batch methods:
+# 15   x,y,z            km             SSB    Earth (from 2 and 9)
+# 16   x,y,z            km             SSB    Moon (from 2 and 9)
+#
+# getAllBodies(jd) returns all 17 of the above as one (17,6) NumPy array.
+# Series missing from the file are zeros there, as are the Earth and Moon
+# unless both 2 and 9 are present.
+#
+# Files holding only some of the series (e.g. written by asc2bin's bin2bin.py)
+# are read the same way, asking for a series that isn't in the file raises a
+# ValueError.
+#
+# relativeState(target,center,jd) uses the body numbers of JPL's testpo files
+# instead: 1-9 Mercury to Pluto, 10 Moon, 11 Sun, 12 SSB, 13 EMB,
+# 14 nutations, 15 librations, 16 lunar mantle angular velocity, 17 TT-TDB
+# and 0 for no center.
 # 
 # Example: (prints x coordinate of venus using first JD available)
 # 
@@ -31,44 +48,357 @@
 # print(de.getPlanet(1,de.getHeader().jdStart)[0])
 #
 # 24857048.341240495
-
+#
+# The file is opened once and memory mapped, blocks are returned as zero-copy
+# views into the mapping (a memoryview of doubles, or a NumPy array from
+# getBlockArray() when NumPy is installed).  Call close(), or use the object
+# in a "with" statement, to release the file.  Using the object after that
+# raises a ValueError.
+#
+# Both little endian files (the usual, and what asc2bin writes) and big
+# endian ones (e.g. older files from JPL) are read as they are, the byte
+# order is worked out from the header.  For big endian files on a little
+# endian machine (or the other way around) getBlock() returns a byte swapped
+# copy of the block, and the NumPy arrays are views with a '>f8' or '<f8'
+# dtype.  Nothing is converted up front.
+#
+# Blocks are kept in a bounded LRU JPLDEBlockCache.  Pass the same cache to
+# several JPLDE objects to share it, e.g.
+#
+# cache=JPLDEBlockCache(maxBlocks=256)
+# a=JPLDE("jpleph.405",cache)
+# b=JPLDE("jpleph.405",cache)
+#
+# A JPLDE object (and its cache) can be shared between threads.  mapStates()
+# spreads a batch over a thread pool.
+#
+# enableStats() starts counting block loads, cache hits and misses, bytes
+# loaded, blocks read by the batch methods and evaluations (calls, epochs
+# and time) per series, see JPLDEStats.
+# getStats() returns a snapshot, and functions added with
+# getStatsObject().addHook() are called for every event, e.g. to forward them
+# to a metrics system.  While disabled (the default) the only cost is a check
+# for None.
+
+import sys
 import struct
 import array
 import math
+import mmap
+import os
+import collections
+import threading
+import time
+import concurrent.futures
+
+try:
+    import numpy
+except ImportError:
+    numpy=None
 
 class JPLDE:
-    def __init__(self,filename):
+    EARTH=15
+    MOON=16
+    bodyCount=17
+
+    #testpo body numbers to the ones above, None is the SSB (always zero)
+    testpoBodies=[None,0,1,15,3,4,5,6,7,8,16,10,None,2,11,12,13,14]
+
+    def __init__(self,filename,cache=None):
         self.filename=filename
-        h=JPLDEHeader(filename)
+        self.file=open(filename,"rb")
+        self.map=mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        self.data=memoryview(self.map)
+
+        #Identifies the file in a shared cache, a rewritten file gets a new key
+        st=os.fstat(self.file.fileno())
+        self.cacheKey=(os.path.realpath(filename),st.st_size,st.st_mtime_ns)
+
+        h=JPLDEHeader.load(filename,self.cacheKey,self.map)
         self.header=h
         self.jdStart=h.jdStart
         self.jdEnd=h.jdEnd
         self.jdStep=h.jdStep
         self.blockSize=h.blockSize
-        self.cachedBlockNum=-1
         self.coeffPtr=h.coeffPtr
 
-    def getBlockForJD(self,jd):
+        #Files in the other byte order are read as they are, each block is
+        #decoded when it's used, see getBlock()
+        self.byteOrder=h.byteOrder
+        self.swapped=(h.byteOrder!=("<" if sys.byteorder=="little" else ">"))
+        self.dtype=numpy.dtype(h.byteOrder+"f8") if numpy is not None else None
+
+        #The first two blocks hold the header, coefficient blocks follow
+        self.blockCount=len(self.map)//self.blockSize-2
+
+        if(cache is None):
+            cache=JPLDEBlockCache()
+        self.cache=cache
+        self.allBodiesPlan=None
+        self.stats=None
+
+    def enableStats(self,stats=None):
+        #Starts counting into stats (a new JPLDEStats unless given, one can be
+        #shared by several files) and returns it
+        if(stats is None):
+            stats=JPLDEStats()
+        self.stats=stats
+        return stats
+
+    def disableStats(self):
+        self.stats=None
+
+    def getStatsObject(self):
+        return self.stats
+
+    def getStats(self):
+        #Snapshot of the counters plus the block cache's, None while disabled
+        if(self.stats is None):
+            return None
+        snapshot=self.stats.getSnapshot()
+        snapshot["cache"]=self.cache.getStats()
+        return snapshot
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        self.close()
+
+    def close(self):
+        #Afterwards every method that reads the file raises a ValueError
+        if(self.map is None):
+            return
+        #The cached blocks are views into the mapping, they'd keep it open
+        self.cache.invalidate(self.cacheKey)
+        self.data.release()
+        try:
+            self.map.close()
+        except BufferError:
+            #Views handed out by getBlock() are still alive, the mapping
+            #will be released when the last of them is garbage collected.
+            pass
+        self.file.close()
+        self.map=None
+
+    def checkOpen(self):
+        if(self.map is None):
+            raise ValueError(f"JPLDE is closed ({self.filename})")
+
+    def getHeader(self):
+        return self.header
+
+    def getBlockOffset(self,blockNum):
+        #Every read of the mapping starts here
+        self.checkOpen()
+        return blockNum*self.blockSize + 2*self.blockSize
+
+    def getBlock(self,blockNum):
+        offset=self.getBlockOffset(blockNum)
+        if(self.swapped):
+            #A byte swapped copy of this block only, kept by the block cache
+            #like any other block
+            block=array.array("d")
+            block.frombytes(self.data[offset:offset+self.blockSize])
+            block.byteswap()
+            return memoryview(block)
+        return self.data[offset:offset+self.blockSize].cast("d")
+
+    def getBlockArray(self,blockNum):
+        JPLDE.requireNumpy()
+        #Same as getBlock(), but as a read only NumPy array sharing the
+        #mapping.  For files in the other byte order the array's dtype has
+        #that order, NumPy swaps the values as they're used.
+        return numpy.frombuffer(self.map,dtype=self.dtype,count=self.blockSize//8,offset=self.getBlockOffset(blockNum))
+
+    def getCoefficientArray(self):
+        #All coefficient blocks as one read only (blockCount, blockSize/8)
+        #NumPy array, in the file's byte order like getBlockArray()
+        JPLDE.requireNumpy()
+        a=numpy.frombuffer(self.map,dtype=self.dtype,count=self.blockCount*self.blockSize//8,offset=self.getBlockOffset(0))
+        return a.reshape(self.blockCount,self.blockSize//8)
+
+    def getBlockNumber(self,jd):
+        if(jd<self.jdStart or jd>self.jdEnd):
+            raise ValueError(f"JD {jd} outside of ephemeris range {self.jdStart} to {self.jdEnd}")
         jdoffset=jd-self.jdStart
-        blockNum=int(jdoffset/self.jdStep)
+        #jdEnd itself belongs to the last block
+        return min(int(jdoffset/self.jdStep),self.blockCount-1)
 
-        if(not self.cachedBlockNum==blockNum):
-            f=open(self.filename,"rb")
-            f.seek(blockNum*self.blockSize + 2*self.blockSize)
-            bin=f.read(self.blockSize)
-            f.close()
-            self.cachedBlockNum=blockNum
-            self.block=array.array("d",bin)
-
-        return self.block
+    def getBlockForJD(self,jd):
+        #A cache shared with another JPLDE object on the same file may have
+        #the block even after close()
+        self.checkOpen()
+        blockNum=self.getBlockNumber(jd)
+
+        #No per object state is changed here, so lookups from several
+        #threads can't see each other's blocks.
+        key=(self.cacheKey,blockNum)
+        block=self.cache.get(key)
+        stats=self.stats
+        if(block is None):
+            if(stats is not None):
+                start=time.perf_counter()
+            block=self.getBlock(blockNum)
+            self.cache.put(key,block,self.blockSize)
+            if(stats is not None):
+                stats.blockLoaded(blockNum,self.blockSize,time.perf_counter()-start)
+        elif(stats is not None):
+            stats.cacheHit(blockNum)
+        return block
 
     def getPlanet(self,planet,jd):
         block=self.getBlockForJD(jd)
+        return self.computeBody(planet,jd,block)
+
+    def computeBody(self,body,jd,block):
+        #computeSeries() that also accepts the derived bodies
+        return self.computeBodies([body],jd,block)[0]
+
+    def computeBodies(self,bodies,jd,block):
+        #States of several bodies, each series they need is evaluated once
+        series={}
+        for body in bodies:
+            for s in JPLDE.getSeriesForBody(body):
+                if(s not in series):
+                    series[s]=self.computeSeries(s,jd,block)
+
+        states=[]
+        for body in bodies:
+            if(body<JPLDE.EARTH):
+                states.append(list(series[body]))
+                continue
+            emb=series[2]
+            moon=series[9]
+            state=[0,0,0,0,0,0]
+            for i in range(6):
+                state[i]=emb[i]-moon[i]/(1.0+self.header.emrat)
+                if(body==JPLDE.MOON):
+                    state[i]+=moon[i]
+            states.append(state)
+        return states
+
+    @staticmethod
+    def getSeriesForBody(body):
+        if(body<JPLDE.EARTH):
+            return (body,)
+        return (2,9)
+
+    def relativeState(self,target,center,jds):
+        #State of target relative to center (testpo numbering, see above) in
+        #km and km/day.  A scalar JD returns a list of 6 values, an array of
+        #JDs returns an array of shape jds.shape+(6,).
+        if(target<1 or target>=len(JPLDE.testpoBodies) or center<0 or center>=len(JPLDE.testpoBodies)):
+            raise ValueError(f"Unknown target/center: {target}/{center}")
+        targetBody=JPLDE.testpoBodies[target]
+        centerBody=JPLDE.testpoBodies[center] if center>0 else None
+        bodies=[b for b in (targetBody,centerBody) if b is not None]
+
+        if(numpy is None or numpy.ndim(jds)==0):
+            states=[]
+            if(len(bodies)>0):
+                states=self.computeBodies(bodies,jds,self.getBlockForJD(jds))
+            zero=[0,0,0,0,0,0]
+            t=states.pop(0) if targetBody is not None else zero
+            c=states.pop(0) if centerBody is not None else zero
+            return [t[i]-c[i] for i in range(6)]
+
+        jds=numpy.asarray(jds,dtype=numpy.float64)
+        states=[]
+        if(len(bodies)>0):
+            states=list(self.getStates(bodies,jds))
+        zero=numpy.zeros(jds.shape+(6,))
+        t=states.pop(0) if targetBody is not None else zero
+        c=states.pop(0) if centerBody is not None else zero
+        return t-c
+
+    def getAllBodies(self,jd):
+        #Every body at jd from a single block lookup, as a (17,6) array
+        #indexed by the body numbers above.  Series missing from the file
+        #are left as zeros, and so are the Earth and Moon if 2 or 9 is.
+        JPLDE.requireNumpy()
+        if(self.allBodiesPlan is None):
+            self.allBodiesPlan=JPLDEAllBodiesPlan(self)
+        plan=self.allBodiesPlan
+
+        block=self.getBlockForJD(jd)
+        stats=self.stats
+        if(stats is not None):
+            evaluationStart=time.perf_counter()
+        #Plain floats, scalar arithmetic on NumPy floats is much slower
+        startJD=block[0]
+        blockDuration=block[1]-startJD
+        block=numpy.frombuffer(block,dtype=numpy.float64)
+
+        #Series with the same number of subintervals share x, and T_n(x)
+        #doesn't depend on how many terms are used, so one basis serves each
+        #group of them.
+        subintervals=[]
+        t=[]
+        v=[]
+        for subint in plan.subints:
+            subintervalDuration=blockDuration/subint
+            subintervalNumber=min(subint-1,math.floor((jd-startJD)/subintervalDuration))
+            x=((jd-(startJD+subintervalDuration*subintervalNumber))/subintervalDuration)*2-1
+            basis=JPLDE.chebyshevBasis(x,plan.maxCoefficients)
+            subintervals.append(subintervalNumber)
+            t.append(basis[0])
+            v.append(basis[1])
+
+        #Coefficients of every component of every series, one row each
+        rowSubinterval=numpy.array(subintervals)[plan.rowGroup]
+        c=block[(plan.rowBase+rowSubinterval*plan.rowStride)[:,None]+plan.terms]*plan.mask
+        position=numpy.einsum("rn,rn->r",c,numpy.array(t)[plan.rowGroup])
+        velocity=numpy.einsum("rn,rn->r",c,numpy.array(v)[plan.rowGroup])*(plan.rowScale/blockDuration)
+
+        states=numpy.zeros(JPLDE.bodyCount*6)
+        states[plan.positionIndex]=position
+        states[plan.velocityIndex]=velocity
+        states=states.reshape(JPLDE.bodyCount,6)
+        if(plan.hasEarthMoon):
+            JPLDE.deriveEarthMoon(states,self.header.emrat)
+        if(stats is not None):
+            elapsed=(time.perf_counter()-evaluationStart)/len(plan.series)
+            for s in plan.series:
+                stats.evaluated(s,1,elapsed)
+        return states
+
+    def getAllBodiesBatch(self,jds):
+        #getAllBodies() for an array of JDs, returns an array of shape
+        #jds.shape+(17,6)
+        JPLDE.requireNumpy()
+        jds=numpy.asarray(jds,dtype=numpy.float64)
+        series=self.getSeriesPresent()
+        evaluated=self.getStates(series,jds.ravel())
+        states=numpy.zeros((len(evaluated[0]),JPLDE.bodyCount,6))
+        for i in range(len(series)):
+            states[:,series[i]]=evaluated[i]
+        if(2 in series and 9 in series):
+            JPLDE.deriveEarthMoon(states,self.header.emrat)
+        return states.reshape(jds.shape+(JPLDE.bodyCount,6))
+
+    @staticmethod
+    def deriveEarthMoon(states,emrat):
+        #Fills in the Earth and the barycentric Moon from the EMB and the
+        #geocentric Moon along the second to last axis of states
+        states[...,JPLDE.EARTH,:]=states[...,2,:]-states[...,9,:]/(1.0+emrat)
+        states[...,JPLDE.MOON,:]=states[...,JPLDE.EARTH,:]+states[...,9,:]
+
+    def getSeriesPresent(self):
+        #Series that have coefficients in this file
+        return [i for i in range(len(self.coeffPtr)) if self.coeffPtr[i][1]>0 and self.coeffPtr[i][2]>0]
+
+    def computeSeries(self,planet,jd,block):
         d=self.coeffPtr[planet]
         seriesOffset=d[0]-1
         ccount=d[1]
         subint=d[2]
         varCount=self.header.seriesVars[planet]
+        if(ccount==0 or subint==0):
+            raise ValueError(f"Series {planet} is not in {self.filename}")
+        stats=self.stats
+        if(stats is not None):
+            evaluationStart=time.perf_counter()
 
         startJD=block[0]
         endJD=block[1]
@@ -76,51 +406,208 @@ class JPLDE:
 
         subintervalDuration=blockDuration/subint
         subintervalSize=ccount*varCount
-        subintervalNumber=math.floor((jd-startJD)/subintervalDuration)
+        #jdEnd itself belongs to the last subinterval
+        subintervalNumber=min(subint-1,math.floor((jd-startJD)/subintervalDuration))
         subintervalStart=subintervalDuration*subintervalNumber
-        subintervalEnd=subintervalDuration*subintervalNumber+subintervalDuration
 
         #Normalize time variable (x) to be in the range -1 to 1 over the given subinterval
         #If using two doubles for JD, this is where the two parts should be combined:
         #e.g. jd=(JD[0]-(startJD+subintervalStart))+JD[1]
         x=((jd-(startJD+subintervalStart))/subintervalDuration)*2-1
 
+        #The basis only depends on x, so it is shared by all components
+        t,v=JPLDE.chebyshevBasis(x,ccount)
         properties=[0,0,0,0,0,0]
-        for i in range(varCount):
-            offset=seriesOffset+i*ccount+subintervalSize*subintervalNumber
-            t=self.computePolynomial(x,block[offset:offset+ccount])
-            properties[i]=t[0]
-
-            velocity = t[1]
-            velocity=velocity*((2.0)*subint/blockDuration)
-            properties[i+varCount]=velocity
-        
+        offset=seriesOffset+subintervalSize*subintervalNumber
+        JPLDE.evaluateComponents(block,offset,ccount,varCount,t,v,(2.0)*subint/blockDuration,properties)
+        if(stats is not None):
+            stats.evaluated(planet,1,time.perf_counter()-evaluationStart)
         return properties
 
     def computePolynomial(self,x,coefficients):
-        #Equation 14.20 from Explanetory Supplement 3rd ed.
-        t=[1,x]
+        t,v=JPLDE.chebyshevBasis(x,len(coefficients))
+        properties=[0,0]
+        JPLDE.evaluateComponents(coefficients,0,len(coefficients),1,t,v,1,properties)
+        return properties
 
-        for n in range(2,len(coefficients)):
-            tn=2*x*t[n-1]-t[n-2]
-            t.append(tn)
+    @staticmethod
+    def chebyshevBasis(x,count):
+        #Equation 14.20 from Explanetory Supplement 3rd ed.
+        #t holds T_n(x), v holds its derivative (for the velocity)
+        t=[0]*count
+        v=[0]*count
+        t[0]=1
+        if(count>1):
+            t[1]=x
+            v[1]=1
+        for n in range(2,count):
+            t[n]=2*x*t[n-1]-t[n-2]
+            v[n]=2*x*v[n-1]+2*t[n-1]-v[n-2]
+        return t,v
 
-        #Multiply the polynomial by the coefficients.
+    @staticmethod
+    def evaluateComponents(coefficients,offset,ccount,varCount,t,v,velocityScale,properties):
+        #Position and velocity of each of the varCount components stored one
+        #after the other starting at coefficients[offset], written to
+        #properties[0:varCount] and properties[varCount:2*varCount].
         #Loop through coefficients backwards (from smallest to largest) to avoid floating point rounding errors
-        position=0
-        for i in range(len(coefficients)-1,-1,-1):
-            position+=coefficients[i]*t[i]
+        for i in range(varCount):
+            start=offset+i*ccount
+            position=0
+            velocity=0
+            for n in range(ccount-1,-1,-1):
+                c=coefficients[start+n]
+                position+=c*t[n]
+                velocity+=c*v[n]
+            properties[i]=position
+            properties[i+varCount]=velocity*velocityScale
+
+    #Number of epochs evaluated at once by the batch methods, bounds the size
+    #of the temporary coefficient and basis arrays.
+    batchChunkSize=65536
+
+    def getPlanetBatch(self,planet,jds):
+        #Vectorized getPlanet(), returns an array of shape jds.shape+(6,)
+        return self.getStates([planet],jds)[0]
+
+    def getStates(self,planets,jds):
+        #Evaluates each planet at every JD, returns an array of shape
+        #(len(planets),)+jds.shape+(6,)
+        JPLDE.requireNumpy()
+        jds=numpy.asarray(jds,dtype=numpy.float64)
+        shape=jds.shape
+        jds=jds.ravel()
+        coefficients=self.getCoefficientArray()
+        blocks=self.getBlockNumbers(jds)
+        startJD=coefficients[blocks,0]
+        blockDuration=coefficients[blocks,1]-startJD
+
+        #Each series is evaluated once, however many of the bodies need it
+        series={}
+        bytesRead=0
+        readTime=0.0
+        for body in planets:
+            for s in JPLDE.getSeriesForBody(body):
+                if(s not in series):
+                    series[s]=numpy.zeros((len(jds),6))
+                    size,seconds=self.evaluateSeriesBatch(s,jds,blocks,startJD,blockDuration,coefficients,series[s])
+                    bytesRead+=size
+                    readTime+=seconds
+
+        #The coefficients come straight from the mapping, not through the
+        #block cache, so they're counted as a batch read of every block used
+        stats=self.stats
+        if(stats is not None and len(jds)>0):
+            stats.batchRead(len(numpy.unique(blocks)),bytesRead,readTime)
+
+        states=numpy.zeros((len(planets),len(jds),6))
+        for i in range(len(planets)):
+            if(planets[i]<JPLDE.EARTH):
+                states[i]=series[planets[i]]
+                continue
+            numpy.subtract(series[2],series[9]/(1.0+self.header.emrat),out=states[i])
+            if(planets[i]==JPLDE.MOON):
+                states[i]+=series[9]
+        return states.reshape((len(planets),)+shape+(6,))
+
+    def mapStates(self,bodies,jds,workers=None,executor=None):
+        #getStates() with the epochs split into chunks evaluated on a thread
+        #pool (a new one with the given number of workers, or executor).
+        JPLDE.requireNumpy()
+        jds=numpy.asarray(jds,dtype=numpy.float64)
+        shape=jds.shape
+        jds=jds.ravel()
+        states=numpy.zeros((len(bodies),len(jds),6))
+        if(workers is None):
+            workers=min(32,(os.cpu_count() or 1)+4)
+
+        chunkSize=max(1,min(self.batchChunkSize,-(-len(jds)//workers)))
+        def run(start):
+            states[:,start:start+chunkSize]=self.getStates(bodies,jds[start:start+chunkSize])
+
+        if(executor is None):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run,range(0,len(jds),chunkSize)))
+        else:
+            list(executor.map(run,range(0,len(jds),chunkSize)))
+        return states.reshape((len(bodies),)+shape+(6,))
+
+    def getBlockNumbers(self,jds):
+        if(len(jds)>0 and (jds.min()<self.jdStart or jds.max()>self.jdEnd)):
+            raise ValueError(f"JD outside of ephemeris range {self.jdStart} to {self.jdEnd}")
+        blocks=numpy.floor((jds-self.jdStart)/self.jdStep).astype(numpy.intp)
+        #jdEnd itself belongs to the last block
+        numpy.minimum(blocks,self.blockCount-1,out=blocks)
+        return blocks
+
+    def evaluateSeriesBatch(self,planet,jds,blocks,startJD,blockDuration,coefficients,out):
+        #Writes the states to out, returns (bytes of coefficients read,
+        #seconds spent reading them).  The time is only measured while
+        #stats are enabled.
+        d=self.coeffPtr[planet]
+        seriesOffset=d[0]-1
+        ccount=d[1]
+        subint=d[2]
+        varCount=self.header.seriesVars[planet]
+        if(ccount==0 or subint==0):
+            raise ValueError(f"Series {planet} is not in {self.filename}")
+        stats=self.stats
+        if(stats is not None):
+            evaluationStart=time.perf_counter()
+        subintervalSize=ccount*varCount
 
-        #Compute velocity (just the derivitave of the above)
-        v=[0,1,4*x]
-        for n in range(3,len(coefficients)):
-            v.append(2*x*v[n-1]+2*t[n-1]-v[n-2])
+        subintervalDuration=blockDuration/subint
+        subintervalNumber=numpy.floor((jds-startJD)/subintervalDuration).astype(numpy.intp)
+        numpy.clip(subintervalNumber,0,subint-1,out=subintervalNumber)
+        x=((jds-(startJD+subintervalDuration*subintervalNumber))/subintervalDuration)*2-1
+        velocityScale=(2.0*subint)/blockDuration
+
+        groupIds=blocks*subint+subintervalNumber
+        bytesRead=0
+        readTime=0.0
+        for start in range(0,len(jds),self.batchChunkSize):
+            end=start+self.batchChunkSize
+            #Epochs of the chunk in the same block and subinterval share
+            #coefficients, gather them once per group
+            if(stats is not None):
+                readStart=time.perf_counter()
+            groups,inverse=numpy.unique(groupIds[start:end],return_inverse=True)
+            columns=seriesOffset+(groups%subint)[:,None]*subintervalSize+numpy.arange(subintervalSize)
+            groupCoefficients=coefficients[(groups//subint)[:,None],columns].reshape(len(groups),varCount,ccount)
+            #Only the coefficients gathered are put in native byte order
+            groupCoefficients=groupCoefficients.astype(numpy.float64,copy=False)
+            bytesRead+=groupCoefficients.nbytes
+            if(stats is not None):
+                readTime+=time.perf_counter()-readStart
+
+            t,v=JPLDE.chebyshevBasisBatch(x[start:end],ccount)
+            c=groupCoefficients[inverse]
+            out[start:end,0:varCount]=numpy.einsum("nvc,nc->nv",c,t)
+            out[start:end,varCount:2*varCount]=numpy.einsum("nvc,nc->nv",c,v)*velocityScale[start:end,None]
+        if(stats is not None):
+            stats.evaluated(planet,len(jds),time.perf_counter()-evaluationStart-readTime)
+        return bytesRead,readTime
 
-        velocity=0
-        for i in range(len(coefficients)-1,-1,-1):
-            velocity+=v[i]*coefficients[i]
+    @staticmethod
+    def chebyshevBasisBatch(x,count):
+        #Chebyshev polynomials T_n(x) and their derivatives for an array of x,
+        #each returned as an array of shape (len(x), count)
+        t=numpy.empty((len(x),count))
+        v=numpy.empty((len(x),count))
+        t[:,0]=1
+        v[:,0]=0
+        if(count>1):
+            t[:,1]=x
+            v[:,1]=1
+        for n in range(2,count):
+            t[:,n]=2*x*t[:,n-1]-t[:,n-2]
+            v[:,n]=2*x*v[:,n-1]+2*t[:,n-1]-v[:,n-2]
+        return t,v
 
-        return [position,velocity]
+    @staticmethod
+    def requireNumpy():
+        if(numpy is None):
+            raise ImportError("NumPy is required for array based evaluation")
 
     @staticmethod
     def getEarthPositionFromEMB(emb,moon):
@@ -130,11 +617,237 @@ class JPLDE:
             earth[i]=emb[i]-moon[i]/(1.0+earthMoonRatio)
         return earth
 
+class JPLDEAllBodiesPlan:
+    #Index arrays used by JPLDE.getAllBodies() to evaluate every series of a
+    #block in a few array operations.  Each component of each series is a
+    #row, padded with zeros to the longest series.
+    def __init__(self,de):
+        series=de.getSeriesPresent()
+        self.series=series
+        #The Earth and Moon need both the EMB and the geocentric Moon
+        self.hasEarthMoon=(2 in series and 9 in series)
+        self.subints=sorted(set(de.coeffPtr[i][2] for i in series))
+        self.maxCoefficients=max(de.coeffPtr[i][1] for i in series)
+
+        rowGroup=[]
+        rowBase=[]
+        rowStride=[]
+        rowScale=[]
+        mask=[]
+        positionIndex=[]
+        velocityIndex=[]
+        for i in series:
+            d=de.coeffPtr[i]
+            ccount=d[1]
+            subint=d[2]
+            varCount=de.header.seriesVars[i]
+            for j in range(varCount):
+                rowGroup.append(self.subints.index(subint))
+                rowBase.append(d[0]-1+j*ccount)
+                rowStride.append(ccount*varCount)
+                rowScale.append(2.0*subint)
+                mask.append([1.0]*ccount+[0.0]*(self.maxCoefficients-ccount))
+                positionIndex.append(i*6+j)
+                velocityIndex.append(i*6+varCount+j)
+
+        self.rowGroup=numpy.array(rowGroup)
+        self.rowBase=numpy.array(rowBase)
+        self.rowStride=numpy.array(rowStride)
+        self.rowScale=numpy.array(rowScale)
+        self.mask=numpy.array(mask)
+        #Padding terms point at the first coefficient of the row, the mask
+        #zeroes them out
+        self.terms=(numpy.arange(self.maxCoefficients)*(self.mask>0)).astype(numpy.intp)
+        self.positionIndex=numpy.array(positionIndex)
+        self.velocityIndex=numpy.array(velocityIndex)
+
+class JPLDEStats:
+    #Counters for one or more JPLDE objects, see JPLDE.enableStats().  Hooks
+    #are called as hook(event,data) with event "blockLoad", "cacheHit",
+    #"batchRead" or "evaluate" and a dict describing it.  They run on the
+    #calling thread, so they should be quick.
+    #
+    #blockLoads and cacheHits count the scalar methods' block lookups.  The
+    #batch methods (getStates() and everything built on it) read the mapping
+    #directly, each call is one batch read: the distinct blocks it used, the
+    #bytes of coefficients gathered and the time spent gathering them.
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.hooks=[]
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.blockLoads=0
+            self.cacheHits=0
+            self.bytesLoaded=0
+            self.blockLoadTime=0.0
+            self.batchReads=0
+            self.batchBlocks=0
+            self.batchBytesRead=0
+            self.batchReadTime=0.0
+            #Series number -> [calls, epochs, seconds]
+            self.evaluations={}
+
+    def addHook(self,hook):
+        self.hooks.append(hook)
+
+    def removeHook(self,hook):
+        self.hooks.remove(hook)
+
+    def blockLoaded(self,blockNum,size,seconds):
+        with self.lock:
+            self.blockLoads+=1
+            self.bytesLoaded+=size
+            self.blockLoadTime+=seconds
+        for hook in self.hooks:
+            hook("blockLoad",{"block":blockNum,"bytes":size,"seconds":seconds})
+
+    def batchRead(self,blocks,size,seconds):
+        with self.lock:
+            self.batchReads+=1
+            self.batchBlocks+=blocks
+            self.batchBytesRead+=size
+            self.batchReadTime+=seconds
+        for hook in self.hooks:
+            hook("batchRead",{"blocks":blocks,"bytes":size,"seconds":seconds})
+
+    def cacheHit(self,blockNum):
+        with self.lock:
+            self.cacheHits+=1
+        for hook in self.hooks:
+            hook("cacheHit",{"block":blockNum})
+
+    def evaluated(self,series,epochs,seconds):
+        with self.lock:
+            e=self.evaluations.get(series)
+            if(e is None):
+                e=self.evaluations[series]=[0,0,0.0]
+            e[0]+=1
+            e[1]+=epochs
+            e[2]+=seconds
+        for hook in self.hooks:
+            hook("evaluate",{"series":series,"epochs":epochs,"seconds":seconds})
+
+    def getSnapshot(self):
+        with self.lock:
+            lookups=self.blockLoads+self.cacheHits
+            return {
+                "blockLoads":self.blockLoads,
+                "cacheHits":self.cacheHits,
+                "hitRate":self.cacheHits/lookups if lookups>0 else 0.0,
+                "bytesLoaded":self.bytesLoaded,
+                "blockLoadTime":self.blockLoadTime,
+                "batchReads":self.batchReads,
+                "batchBlocks":self.batchBlocks,
+                "batchBytesRead":self.batchBytesRead,
+                "batchReadTime":self.batchReadTime,
+                "evaluationTime":sum(e[2] for e in self.evaluations.values()),
+                "evaluations":{s:{"calls":e[0],"epochs":e[1],"seconds":e[2]} for s,e in sorted(self.evaluations.items())}
+            }
+
+class JPLDEBlockCache:
+    #Least recently used cache of coefficient blocks, bounded by a number of
+    #blocks and/or a number of bytes (None for no limit).  Safe to use from
+    #several threads.
+    def __init__(self,maxBlocks=64,maxBytes=None):
+        self.maxBlocks=maxBlocks
+        self.maxBytes=maxBytes
+        self.lock=threading.Lock()
+        self.blocks=collections.OrderedDict()
+        self.size=0
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self,key):
+        with self.lock:
+            entry=self.blocks.get(key)
+            if(entry is None):
+                self.misses+=1
+                return None
+            self.blocks.move_to_end(key)
+            self.hits+=1
+            return entry[0]
+
+    def put(self,key,block,size):
+        with self.lock:
+            old=self.blocks.pop(key,None)
+            if(old is not None):
+                self.size-=old[1]
+            self.blocks[key]=(block,size)
+            self.size+=size
+            while(len(self.blocks)>1 and ((self.maxBlocks is not None and len(self.blocks)>self.maxBlocks) or (self.maxBytes is not None and self.size>self.maxBytes))):
+                self.size-=self.blocks.popitem(last=False)[1][1]
+                self.evictions+=1
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.size=0
+
+    def invalidate(self,fileKey):
+        #Drops the blocks of one file (a JPLDE cacheKey)
+        with self.lock:
+            for key in [k for k in self.blocks if k[0]==fileKey]:
+                self.size-=self.blocks.pop(key)[1]
+
+    def getStats(self):
+        with self.lock:
+            lookups=self.hits+self.misses
+            return {
+                "blocks":len(self.blocks),
+                "bytes":self.size,
+                "hits":self.hits,
+                "misses":self.misses,
+                "evictions":self.evictions,
+                "hitRate":self.hits/lookups if lookups>0 else 0.0
+            }
+
 class JPLDEHeader:
-    def __init__(self,filename):
+    #Start of the header up to the 401st constant name, see
+    #BinaryHeaderFormat.txt.  No alignment padding, one layout per byte
+    #order: "<" little endian (what asc2bin writes) and ">" big endian.
+    layoutFormat="84s84s84s2400s3di2d36ii3i"
+    layouts={"<":struct.Struct("<"+layoutFormat),">":struct.Struct(">"+layoutFormat)}
+
+    #Byte offsets of the fields used to tell the byte order
+    jdStepOffset=2668
+    numConstantsOffset=2676
+    versionOffset=2840
+
+    #Bytes read at once, enough for both header records of any DE file
+    readSize=65536
+
+    #Parsed headers by (real path, size, mtime), see load()
+    cache={}
+    cacheLock=threading.Lock()
+
+    def __init__(self,filename,data=None):
+        #data can be the file's contents (e.g. a memory mapping) so the file
+        #isn't read again.
         self.seriesVars=[3,3,3,3,3,3,3,3,3,3,3,2,3,3,1]
         self.filename=filename
-        self.loadHeader(filename)
+        self.constantMap=None
+        self.loadHeader(filename,data)
+
+    @staticmethod
+    def load(filename,key=None,data=None):
+        #JPLDEHeader(filename), parsed once per version of the file.  key is
+        #(real path, size, mtime), computed when not given.
+        if(key is None):
+            st=os.stat(filename)
+            key=(os.path.realpath(filename),st.st_size,st.st_mtime_ns)
+        with JPLDEHeader.cacheLock:
+            h=JPLDEHeader.cache.get(key)
+        if(h is None):
+            h=JPLDEHeader(filename,data)
+            with JPLDEHeader.cacheLock:
+                JPLDEHeader.cache[key]=h
+        return h
 
     def findRecLength(self):
         for i in range(len(self.coeffPtr)-1,-1,-1):
@@ -143,59 +856,60 @@ class JPLDEHeader:
                 reclen=cp[0]+(cp[1]*cp[2]*self.seriesVars[i])-1
                 return reclen*8
 
-    def loadHeader(self,filename):
-        f=open(filename,"rb")
-
-        self.description=f.read(84)
-        self.startString=f.read(84)
-        self.endString=f.read(84)
-        self.constantNames=[]
-        for i in range(400):
-            self.constantNames.append(f.read(6))
-
-        self.jdStart=struct.unpack("d",f.read(8))[0]
-        self.jdEnd=struct.unpack("d",f.read(8))[0]
-        self.jdStep=struct.unpack("d",f.read(8))[0]
-        self.numConstants=struct.unpack("l",f.read(4))[0]
-        self.au=struct.unpack("d",f.read(8))[0]
-        self.emrat=struct.unpack("d",f.read(8))[0]
-
-        self.coeffPtr=[]
-        #Group 1050 data
-        for i in range(12):
-            self.coeffPtr.append([])
-            for j in range(3):
-                self.coeffPtr[i].append(struct.unpack("l",f.read(4))[0])
-
-        self.version=struct.unpack("l",f.read(4))[0]
-
-        #more Group 1050 data
-        self.coeffPtr.append([])
-        for i in range(3):
-            self.coeffPtr[12].append(struct.unpack("l",f.read(4))[0])
-
-        #more constant names, if there's more than 400
-        if(self.numConstants>400):
-            for i in range(self.numConstants-400):
-                self.constantNames.append(f.read(6))
-
-        #more Group 1050 data
-        self.coeffPtr.append([])
-        for i in range(3):
-            self.coeffPtr[13].append(struct.unpack("l",f.read(4))[0])
-
-        #more Group 1050 data
-        self.coeffPtr.append([])
-        for i in range(3):
-            self.coeffPtr[14].append(struct.unpack("l",f.read(4))[0])
-
-        #Compute block size based on offsets in Group 1050
+    @staticmethod
+    def detectByteOrder(filename,data):
+        #The byte order in which jdStep, the number of constants and the DE
+        #version all make sense, the machine's own order is tried first.
+        #In the other order the integers come out negative or in the
+        #millions and jdStep is tiny or huge.
+        orders=["<",">"] if sys.byteorder=="little" else [">","<"]
+        for order in orders:
+            jdStep=struct.unpack_from(order+"d",data,JPLDEHeader.jdStepOffset)[0]
+            numConstants=struct.unpack_from(order+"i",data,JPLDEHeader.numConstantsOffset)[0]
+            version=struct.unpack_from(order+"i",data,JPLDEHeader.versionOffset)[0]
+            if(jdStep>=0.001 and jdStep<=100000 and numConstants>0 and numConstants<=10000 and version>=0 and version<100000):
+                return order
+        raise ValueError(f"{filename} is not a JPL DE file, its header doesn't make sense in either byte order")
+
+    def loadHeader(self,filename,data=None):
+        f=None
+        if(data is None):
+            f=open(filename,"rb")
+            data=f.read(self.readSize)
+
+        self.byteOrder=JPLDEHeader.detectByteOrder(filename,data)
+        layout=self.layouts[self.byteOrder]
+        (self.description,self.startString,self.endString,names,
+            self.jdStart,self.jdEnd,self.jdStep,self.numConstants,self.au,self.emrat,
+            *pointers)=layout.unpack_from(data,0)
+        self.version=pointers[36]
+        self.constantNames=[names[i:i+6] for i in range(0,len(names),6)]
+
+        #Group 1050 data, the last two series come after the constant names
+        #past 400
+        offset=layout.size
+        extraNames=max(0,self.numConstants-400)
+        self.constantNames.extend(data[offset+i*6:offset+i*6+6] for i in range(extraNames))
+        pointers=pointers[0:36]+pointers[37:40]+list(struct.unpack_from(self.byteOrder+"6i",data,offset+6*extraNames))
+        self.coeffPtr=[list(pointers[i:i+3]) for i in range(0,len(pointers),3)]
+
+        #Compute block size based on offsets in Group 1050, the constants
+        #are the second block
         self.blockSize=self.findRecLength()
-        padSize=self.blockSize-f.tell()
-        f.read(padSize)
-
-        self.constants=[]
-        for i in range(self.numConstants):
-            self.constants.append(struct.unpack("d",f.read(8))[0])
-
-        f.close()
+        end=self.blockSize+8*self.numConstants
+        if(f is not None):
+            if(end>len(data)):
+                data+=f.read(end-len(data))
+            f.close()
+        self.constants=list(struct.unpack_from(self.byteOrder+"%dd" % self.numConstants,data,self.blockSize))
+
+    def getConstants(self):
+        #Constant name -> value, built on first use
+        if(self.constantMap is None):
+            names=[n.decode("ascii","replace").strip(" \x00") for n in self.constantNames[0:self.numConstants]]
+            self.constantMap=dict(zip(names,self.constants))
+        return self.constantMap
+
+    def getConstant(self,name):
+        #e.g. getConstant("AU"), raises a KeyError for unknown names
+        return self.getConstants()[name]
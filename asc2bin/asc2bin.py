@@ -4,8 +4,9 @@ from lib import FileListGetter
 from lib import CommandLineParser
 import sys
 
-cl=CommandLineParser.CommandLineParser(sys.argv)
+if __name__=="__main__":
+    cl=CommandLineParser.CommandLineParser(sys.argv)
 
-lg=FileListGetter.FileListGetter(cl.denum,cl.path,cl.processAllFiles,cl.startJD,cl.endJD)
+    lg=FileListGetter.FileListGetter(cl.denum,cl.path,cl.processAllFiles,cl.startJD,cl.endJD)
 
-h=BinWriter.FileWriter(cl.denum,cl.headerFile,lg.files,cl.outputFile,lg.startJD,lg.endJD)
\ No newline at end of file
+    h=BinWriter.FileWriter(cl.denum,cl.headerFile,lg.files,cl.outputFile,lg.startJD,lg.endJD,cl.jobs,cl.append,lg.ranges)
\ No newline at end of file
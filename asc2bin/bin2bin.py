@@ -0,0 +1,34 @@
+#!/user/bin/python
+from lib import BinExtractor
+import sys
+
+def useage():
+    print("bin2bin.py -- Extracts a JD range from a binary NASA JPL DE file.")
+    print()
+    print("Useage:")
+    print("bin2bin.py [input] [output] [start JD] [end JD] [series]")
+    print("   The output holds every block of the input that overlaps start JD to end JD.")
+    print("   [series] - optional - the series to keep, e.g. 0-10 or 2,9,14 [Default all]")
+    print()
+    print("Examples:")
+    print("   bin2bin.py jpleph.405 jpleph2000-2040.405 2451536.5 2466160.5")
+    print("   bin2bin.py jpleph.405 planets.405 2451536.5 2466160.5 0-10")
+
+def parseSeries(s):
+    series=[]
+    for part in s.split(","):
+        r=part.split("-")
+        series.extend(range(int(r[0]),int(r[-1])+1))
+    return series
+
+if __name__=="__main__":
+    if(len(sys.argv)!=5 and len(sys.argv)!=6):
+        useage()
+        exit()
+
+    series=None
+    if(len(sys.argv)==6):
+        series=parseSeries(sys.argv[5])
+
+    e=BinExtractor.BinExtractor(sys.argv[1],sys.argv[2],float(sys.argv[3]),float(sys.argv[4]),series)
+    print(f"Copied {e.blockCount} blocks of {e.recordSize} bytes to {sys.argv[2]}")
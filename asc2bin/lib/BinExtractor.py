@@ -0,0 +1,94 @@
+from JPLDE import JPLDE
+from lib import BinWriter
+import struct
+import math
+
+class BinExtractor:
+    #Bytes copied per write
+    copySize=64*1024*1024
+
+    #Byte offsets of the coefficient pointers in the binary header, see
+    #BinaryHeaderFormat.txt.  The last two follow the constant names past 400.
+    coeffPtrOffset=2696
+    coeffPtr12Offset=2844
+    coeffPtr13Offset=2856
+
+    def __init__(self,inputFile,outputFile,startJD,endJD,series=None):
+        #Copies the header and the blocks covering startJD..endJD of a binary
+        #file into a new one, then sets the new file's jdStart and jdEnd.
+        #With a list of series only those are kept, see writeSeriesSubset().
+        #The new file has the same byte order as the input.
+        de=JPLDE(inputFile)
+        first=max(0,int((startJD-de.jdStart)/de.jdStep))
+        last=min(de.blockCount-1,math.ceil((endJD-de.jdStart)/de.jdStep)-1)
+        if(last<first):
+            de.close()
+            raise ValueError(f"{inputFile} has no blocks between {startJD} and {endJD} (it covers {de.jdStart} to {de.jdEnd})")
+
+        if(series is None):
+            headerSize=2*de.blockSize
+            recordSize=de.blockSize
+            out=open(outputFile,"wb")
+            out.write(de.data[:headerSize])
+            start=de.getBlockOffset(first)
+            end=de.getBlockOffset(last)+de.blockSize
+            for offset in range(start,end,self.copySize):
+                out.write(de.data[offset:min(offset+self.copySize,end)])
+            out.close()
+        else:
+            recordSize=self.writeSeriesSubset(de,outputFile,first,last,series)
+            headerSize=2*recordSize
+        de.close()
+
+        BinWriter.FileWriter.updateHeaderRange(outputFile,headerSize,recordSize,de.byteOrder)
+        self.blockCount=last-first+1
+        self.recordSize=recordSize
+
+    def writeSeriesSubset(self,de,outputFile,first,last,series):
+        #Writes blocks first..last holding only the given series, with the
+        #coefficient pointers rewritten to match and the pointers of the
+        #dropped series set to zero.  The record also has to hold the header,
+        #if the series are too small for that the extra space goes between
+        #the block's JDs and the first series.  Returns the record size.
+        h=de.header
+        series=sorted(set(series))
+        for s in series:
+            if(s<0 or s>=len(h.coeffPtr) or h.coeffPtr[s][1]==0 or h.coeffPtr[s][2]==0):
+                raise ValueError(f"Series {s} is not in {de.filename}")
+
+        extraNames=max(0,h.numConstants-400)
+        headerLength=self.coeffPtr13Offset+6*extraNames+24
+        sizes=[h.coeffPtr[s][1]*h.coeffPtr[s][2]*h.seriesVars[s] for s in series]
+        minimumLength=-(-max(headerLength,8*h.numConstants)//8)
+        pad=max(0,minimumLength-(2+sum(sizes)))
+        recordSize=(2+pad+sum(sizes))*8
+
+        coeffPtr=[[0,0,0] for i in range(len(h.coeffPtr))]
+        pieces=[]
+        offset=3+pad
+        for i in range(len(series)):
+            p=h.coeffPtr[series[i]]
+            coeffPtr[series[i]]=[offset,p[1],p[2]]
+            pieces.append(((p[0]-1)*8,(p[0]-1+sizes[i])*8))
+            offset+=sizes[i]
+
+        header=bytearray(de.data[:headerLength])
+        for i in range(12):
+            struct.pack_into(de.byteOrder+"3i",header,self.coeffPtrOffset+12*i,*coeffPtr[i])
+        struct.pack_into(de.byteOrder+"3i",header,self.coeffPtr12Offset,*coeffPtr[12])
+        struct.pack_into(de.byteOrder+"6i",header,self.coeffPtr13Offset+6*extraNames,*coeffPtr[13],*coeffPtr[14])
+        header=header.ljust(recordSize,b"\x00")
+        header+=de.data[de.blockSize:de.blockSize+8*h.numConstants]
+        header=header.ljust(2*recordSize,b"\x00")
+
+        out=open(outputFile,"wb",buffering=self.copySize)
+        out.write(header)
+        padding=bytes(pad*8)
+        for blockNum in range(first,last+1):
+            start=de.getBlockOffset(blockNum)
+            out.write(de.data[start:start+16])
+            out.write(padding)
+            for a,b in pieces:
+                out.write(de.data[start+a:start+b])
+        out.close()
+        return recordSize
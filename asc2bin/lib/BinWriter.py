@@ -1,68 +1,294 @@
 from lib import HeaderParser
+from lib import FileListGetter
+import os
+import sys
 import struct
-import re
+import time
+import math
+import array
+import concurrent.futures
 
 class FileWriter:
-    def __init__(self,denum,headerFile,asciiFileList,outputFile,startJD,endJD):
+    #Bytes of ASCII text parsed at a time
+    chunkSize=16*1024*1024
+
+    #Byte offsets in the binary header, see BinaryHeaderFormat.txt
+    jdStartOffset=2652
+    jdStepOffset=2668
+    numConstantsOffset=2676
+    coeffPtrOffset=2696
+    versionOffset=2840
+    coeffPtr13Offset=2856
+
+    def __init__(self,denum,headerFile,asciiFileList,outputFile,startJD,endJD,jobs=1,append=False,fileRanges=None):
+        #fileRanges are the (file, start JD, end JD, ...) of the ASCII files,
+        #e.g. FileListGetter.ranges.  Read from the files when not given.
         self.denum=denum
+        if(fileRanges is None):
+            fileRanges=[(f,FileListGetter.FileListGetter._getStartJDForFile(f),FileListGetter.FileListGetter._getEndJDForFile(f)) for f in asciiFileList]
+        self.fileRanges={r[0]:(r[1],r[2]) for r in fileRanges}
         self.lastBlockJD=-9E30
         asciiheader=HeaderParser.ASCIIHeaderParser.parseHeader(headerFile)
         binheader=self.createBinaryHeader(asciiheader,denum,startJD,endJD)
+        headerSize=len(binheader)
+        recordSize=int(asciiheader.blockSize)*8
 
-        f=open(outputFile,"wb")
-        f.write(binheader)
-        f.close()
-        
-        for file in asciiFileList:
-            print("Processing: "+file)
-            self.appendASCIIFile(outputFile,file,startJD,endJD)
+        baseJD=None
+        existingBlocks=0
+        if(append and os.path.exists(outputFile) and os.path.getsize(outputFile)>=headerSize):
+            #Blocks are placed relative to the first one kept, with none kept
+            #the file is filled as if it were new
+            firstJD,existingBlocks=self.resumeBinaryFile(outputFile,binheader,recordSize,asciiheader.jdStep)
+            if(existingBlocks>0):
+                baseJD=firstJD
+                print(f"Appending after {existingBlocks} blocks (JD {baseJD} to {self.lastBlockJD+asciiheader.jdStep})")
+                asciiFileList=[f for f in asciiFileList if self.fileRanges[f][1]-asciiheader.jdStep>self.lastBlockJD]
+        if(existingBlocks==0):
+            f=open(outputFile,"wb")
+            f.write(binheader)
+            f.close()
 
-    def getNcoeffFromDividerLine(self,l):
-        l=l.strip()
-        t=re.split("\s+",l)
-        return int(t[1])
+        started=time.perf_counter()
+        totalBytes=0
+        if(jobs<=0):
+            jobs=os.cpu_count() or 1
+        if(jobs>1 and len(asciiFileList)>1):
+            for file,size,seconds in self.convertParallel(asciiFileList,outputFile,headerSize,recordSize,asciiheader.jdStep,startJD,endJD,jobs,baseJD,existingBlocks):
+                print("Processed: "+file)
+                totalBytes+=size
+                FileWriter.printThroughput("   ",size,seconds)
+        else:
+            for file in asciiFileList:
+                print("Processing: "+file)
+                fileStarted=time.perf_counter()
+                size=self.appendASCIIFile(outputFile,file,startJD,endJD)
+                totalBytes+=size
+                FileWriter.printThroughput("   ",size,time.perf_counter()-fileStarted)
+        FileWriter.printThroughput("Total:",totalBytes,time.perf_counter()-started)
 
-    def appendASCIIFile(self,binaryFilename,asciiFilename,startJD,endJD):
-        ascii=open(asciiFilename,"r")
-        binary=open(binaryFilename,"ab")
-
-        l=ascii.readline()
-        ncoeff=self.getNcoeffFromDividerLine(l)
-
-        ccount=0
-        block=bytearray()
-        notdone=True
-        firstBlock=True
-        while notdone:
-            if(len(l)==0):
-                notdone=False
+        FileWriter.updateHeaderRange(outputFile,headerSize,recordSize)
+
+    @staticmethod
+    def printThroughput(label,size,seconds):
+        mb=size/(1024*1024)
+        print(f"{label} {mb:.1f} MB in {seconds:.2f} s ({mb/max(seconds,1e-9):.1f} MB/s)")
+
+    @staticmethod
+    def readBlocks(asciiFilename):
+        #Parses the ASCII file in large chunks and yields (start JD, coefficients)
+        #for every block, the coefficients as a memoryview of little endian
+        #doubles (the byte order of the binary format) on any machine.
+        ascii=open(asciiFilename,"rb")
+        divider=ascii.readline().split()
+        nextBlock=int(divider[0])
+        ncoeff=int(divider[1])
+        ascii.seek(0)
+
+        #Each block is a divider line (block number and ncoeff) followed by
+        #lines of three coefficients, the last line padded with zeros.
+        stride=2+3*(-(-ncoeff//3))
+
+        pending=[]
+        remainder=b""
+        while True:
+            chunk=ascii.read(FileWriter.chunkSize)
+            if(len(chunk)==0):
+                tokens=pending+remainder.replace(b"D",b"E").split()
             else:
-                ccount=0
-                while ccount<ncoeff:
-                    l=ascii.readline().strip()
-                    arr=re.split("\s+",l)
-                    if ccount==0:
-                        thisBlockJD=float(arr[0].replace("D","E"))
-                    while ccount<ncoeff and len(arr)>0:
-                        d=arr.pop(0)
-                        block+=struct.pack("d",float(d.replace("D","E")))
-                        ccount+=1
-                if thisBlockJD>self.lastBlockJD:
-                    if(thisBlockJD>=startJD and thisBlockJD<=endJD):
-                        binary.write(block)
-                    self.lastBlockJD=thisBlockJD
-                if firstBlock:
-                    self.firstBlockJD=thisBlockJD
-                    firstBlock=False
-                block=bytearray()
-            l=ascii.readline().strip()
+                #Only split complete lines, the rest goes with the next chunk
+                chunk=remainder+chunk
+                cut=chunk.rfind(b"\n")+1
+                remainder=chunk[cut:]
+                tokens=chunk[:cut].replace(b"D",b"E").split()
+                if(len(pending)>0):
+                    tokens=pending+tokens
 
-        binary.close()
+            count=len(tokens)//stride*stride
+            pending=tokens[count:]
+            if(len(chunk)==0 and len(pending)>0):
+                raise ValueError(f"Incomplete block at the end of {asciiFilename} ({len(pending)} extra values)")
+
+            #All the blocks of a chunk are converted at once
+            values=array.array("d",map(float,tokens[:count]))
+
+            #Every block has to start with its divider line (consecutive
+            #block numbers), a missing or extra line shifts all the blocks
+            #after it
+            for number,n in zip(values[0::stride],values[1::stride]):
+                if(number!=nextBlock or n!=ncoeff):
+                    raise ValueError(f"Block {nextBlock} of {asciiFilename} is malformed, found {number:g} {n:g} where its divider line should be")
+                nextBlock+=1
+
+            blockJDs=values[2::stride]
+            if(sys.byteorder=="big"):
+                values.byteswap()
+            view=memoryview(values)
+            for jd,start in zip(blockJDs,range(2,count,stride)):
+                yield jd,view[start:start+ncoeff]
+
+            if(len(chunk)==0):
+                break
         ascii.close()
-        pass
+
+    def appendASCIIFile(self,binaryFilename,asciiFilename,startJD,endJD):
+        #Appends the blocks of the ASCII file to the binary file, skipping
+        #blocks already written from the previous file.  Returns the number
+        #of ASCII bytes read.
+        binary=open(binaryFilename,"ab",buffering=self.chunkSize)
+
+        self.firstBlockJD=None
+        for thisBlockJD,block in FileWriter.readBlocks(asciiFilename):
+            if(self.firstBlockJD is None):
+                self.firstBlockJD=thisBlockJD
+            if thisBlockJD>self.lastBlockJD:
+                if(thisBlockJD>=startJD and thisBlockJD<=endJD):
+                    binary.write(block)
+                self.lastBlockJD=thisBlockJD
+
+        binary.close()
+        return os.path.getsize(asciiFilename)
+
+    def convertParallel(self,asciiFileList,outputFile,headerSize,recordSize,jdStep,startJD,endJD,jobs,baseJD=None,existingBlocks=0):
+        #Converts the files in a pool of processes, each block written at the
+        #offset given by its JD.  A block is kept when it starts after the last
+        #block of every earlier file, same as appendASCIIFile() run in order.
+        #When appending, baseJD is the start of the first block already in the
+        #file.  Yields (file, ASCII bytes, seconds) as the files finish.
+        ranges=[self.fileRanges[f] for f in asciiFileList]
+
+        minJDs=[]
+        lastBlockJD=self.lastBlockJD
+        for i in range(len(ranges)):
+            if(i>0 and ranges[i][0]>ranges[i-1][1]):
+                raise ValueError(f"Gap between {asciiFileList[i-1]} and {asciiFileList[i]} ({ranges[i-1][1]} to {ranges[i][0]})")
+            minJDs.append(lastBlockJD)
+            lastBlockJD=max(lastBlockJD,ranges[i][1]-jdStep)
+        self.lastBlockJD=lastBlockJD
+
+        #The first block written is the first one starting at or after startJD
+        if(baseJD is None):
+            baseJD=ranges[0][0]
+            if(startJD>baseJD):
+                baseJD+=math.ceil((startJD-baseJD)/jdStep)*jdStep
+        blockCount=max(0,math.floor((min(endJD,lastBlockJD)-baseJD)/jdStep)+1)
+
+        f=open(outputFile,"r+b")
+        f.truncate(headerSize+blockCount*recordSize)
+        f.close()
+
+        lastIndex=existingBlocks-1
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures=[executor.submit(FileWriter.convertFile,asciiFileList[i],outputFile,headerSize,recordSize,baseJD,jdStep,minJDs[i],startJD,endJD) for i in range(len(asciiFileList))]
+            for future in concurrent.futures.as_completed(futures):
+                file,size,seconds,index=future.result()
+                lastIndex=max(lastIndex,index)
+                yield file,size,seconds
+
+        f=open(outputFile,"r+b")
+        f.truncate(headerSize+(lastIndex+1)*recordSize)
+        f.close()
+
+    @staticmethod
+    def convertFile(asciiFilename,outputFile,headerSize,recordSize,baseJD,jdStep,minJD,startJD,endJD):
+        #Runs in a worker process.  Writes the blocks of one ASCII file that
+        #start after minJD and inside startJD..endJD to their place in the
+        #preallocated output file.
+        started=time.perf_counter()
+        binary=open(outputFile,"r+b",buffering=FileWriter.chunkSize)
+
+        position=None
+        lastIndex=-1
+        for thisBlockJD,block in FileWriter.readBlocks(asciiFilename):
+            if(thisBlockJD<=minJD or thisBlockJD<startJD or thisBlockJD>endJD):
+                continue
+            index=round((thisBlockJD-baseJD)/jdStep)
+            offset=headerSize+index*recordSize
+            if(offset!=position):
+                binary.seek(offset)
+            binary.write(block)
+            position=offset+recordSize
+            lastIndex=max(lastIndex,index)
+
+        binary.close()
+        return asciiFilename,os.path.getsize(asciiFilename),time.perf_counter()-started,lastIndex
+
+    def resumeBinaryFile(self,outputFile,binheader,recordSize,jdStep):
+        #Keeps the blocks of an existing binary file up to the first one that
+        #is incomplete or out of sequence (an interrupted run, sequential or
+        #parallel), truncates the rest and continues after the last block
+        #kept.  Returns (start JD of the first block, number of blocks kept),
+        #the JD is None when no block is kept (e.g. a parallel run stopped
+        #before the first file was written, leaving zeros at its place).
+        #Raises a ValueError, leaving the file alone, if it wasn't written
+        #from the same ASCII header.
+        headerSize=len(binheader)
+        f=open(outputFile,"r+b")
+        existing=f.read(headerSize)
+        mismatch=FileWriter.compareHeaders(existing,binheader)
+        if(mismatch is not None):
+            f.close()
+            raise ValueError(f"{outputFile} can't be appended to, its {mismatch} doesn't match the ASCII header")
+
+        count=(os.path.getsize(outputFile)-headerSize)//recordSize
+        firstJD=None
+        blocks=0
+        while blocks<count:
+            f.seek(headerSize+blocks*recordSize)
+            s,e=struct.unpack("<dd",f.read(16))
+            if(firstJD is None):
+                firstJD=s
+            if(s!=firstJD+blocks*jdStep or e!=s+jdStep):
+                break
+            blocks+=1
+
+        f.truncate(headerSize+blocks*recordSize)
+        f.close()
+        if(blocks==0):
+            return None,0
+        self.lastBlockJD=firstJD+(blocks-1)*jdStep
+        return firstJD,blocks
+
+    @staticmethod
+    def compareHeaders(existing,binheader):
+        #Name of the first field that differs between an existing binary
+        #header and the one createBinaryHeader() made, None if they match.
+        #jdStart and jdEnd depend on the range converted and aren't compared.
+        numConstants=struct.unpack_from("<i",binheader,FileWriter.numConstantsOffset)[0]
+        coeffPtr13Offset=FileWriter.coeffPtr13Offset+6*max(0,numConstants-400)
+        #The record size follows from the coefficient pointers
+        fields=[
+            ("jdStep",FileWriter.jdStepOffset,8),
+            ("number of constants",FileWriter.numConstantsOffset,4),
+            ("coefficient pointers (record size)",FileWriter.coeffPtrOffset,36*4),
+            ("DE number",FileWriter.versionOffset,4),
+            ("coefficient pointers (record size)",FileWriter.versionOffset+4,12),
+            ("coefficient pointers (record size)",coeffPtr13Offset,24)
+        ]
+        for name,offset,length in fields:
+            if(existing[offset:offset+length]!=binheader[offset:offset+length]):
+                return name
+        return None
+
+    @staticmethod
+    def updateHeaderRange(outputFile,headerSize,recordSize,byteOrder="<"):
+        #Sets jdStart and jdEnd in the header to the blocks actually in the
+        #file.  byteOrder is the file's, ">" for big endian files.
+        f=open(outputFile,"r+b")
+        count=(os.path.getsize(outputFile)-headerSize)//recordSize
+        if(count>0):
+            f.seek(headerSize)
+            jdStart=struct.unpack(byteOrder+"d",f.read(8))[0]
+            f.seek(headerSize+(count-1)*recordSize+8)
+            jdEnd=struct.unpack(byteOrder+"d",f.read(8))[0]
+            f.seek(FileWriter.jdStartOffset)
+            f.write(struct.pack(byteOrder+"dd",jdStart,jdEnd))
+        f.close()
 
     def createBinaryHeader(self,h,denum,jdStart,jdEnd):
-        t=struct.pack("84s",bytes("{:<84}".format(h.description),'utf-8'))
+        #Integers are 32 bits and everything is little endian, see
+        #BinaryHeaderFormat.txt
+        t=bytearray()
+        t+=struct.pack("84s",bytes("{:<84}".format(h.description),'utf-8'))
         t+=struct.pack("84s",bytes("{:<84}".format(h.startString),'utf-8'))
         t+=struct.pack("84s",bytes("{:<84}".format(h.endString),'utf-8'))
 
@@ -70,41 +296,33 @@ class FileWriter:
             if i<len(h.constantNames):
                 t+=struct.pack("6s",bytes("{:<6}".format(h.constantNames[i]),'utf-8'))
             else:
-                t+=struct.pack('6s',bytes('\x00\x00\x00\x00\x00\x00',"utf-8"))
+                t+=bytes(6)
 
-        t+=struct.pack("d",jdStart)
-        t+=struct.pack("d",jdEnd)
-        t+=struct.pack("d",h.jdStep)
-        t+=struct.pack("l",int(h.numConstants))
-        t+=struct.pack("d",float(h.constants[6].replace("D","E")))
-        t+=struct.pack("d",float(h.constants[7].replace("D","E")))
+        t+=struct.pack("<dddi",jdStart,jdEnd,h.jdStep,int(h.numConstants))
+        t+=struct.pack("<dd",float(h.constants[6].replace("D","E")),float(h.constants[7].replace("D","E")))
 
         for i in range(12):
             a=h.coeffPtr[i]
-            t+=struct.pack("lll",int(a[0]),int(a[1]),int(a[2]))
+            t+=struct.pack("<3i",int(a[0]),int(a[1]),int(a[2]))
 
-        t+=struct.pack("l",int(denum))
+        t+=struct.pack("<i",int(denum))
 
         a=h.coeffPtr[12]
-        t+=struct.pack("lll",int(a[0]),int(a[1]),int(a[2]))
+        t+=struct.pack("<3i",int(a[0]),int(a[1]),int(a[2]))
 
         for i in range(int(h.numConstants)-400):
             t+=struct.pack("6s",bytes("{:<6}".format(h.constantNames[i+400]),'utf-8'))
 
         a=h.coeffPtr[13]
-        t+=struct.pack("lll",int(a[0]),int(a[1]),int(a[2]))
+        t+=struct.pack("<3i",int(a[0]),int(a[1]),int(a[2]))
         a=h.coeffPtr[14]
-        t+=struct.pack("lll",int(a[0]),int(a[1]),int(a[2]))
-
-        for i in range(int(h.blockSize)*8-len(t)):
-            t+=struct.pack('c',bytes('\x00',"utf-8"))
+        t+=struct.pack("<3i",int(a[0]),int(a[1]),int(a[2]))
 
-        for i in range(len(h.constants)):
-            t+=struct.pack('d',float(h.constants[i].replace("D","E")))
+        t=t.ljust(int(h.blockSize)*8,b"\x00")
 
-        for i in range(2*int(h.blockSize)*8-len(t)):
-            t+=struct.pack('c',bytes('\x00',"utf-8"))
+        constants=[float(c.replace("D","E")) for c in h.constants]
+        t+=struct.pack("<%dd" % len(constants),*constants)
 
-        return t
+        t=t.ljust(2*int(h.blockSize)*8,b"\x00")
 
-    
+        return bytes(t)
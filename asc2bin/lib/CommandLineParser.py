@@ -10,6 +10,8 @@ class CommandLineParser:
         self.startJD=""
         self.endJD=""
         self.processAllFiles=True
+        self.jobs=1
+        self.append=False
 
         self.parse(arr)
         if(self.denum==None):
@@ -49,6 +51,12 @@ class CommandLineParser:
                 self.endJD=float(self.getopt(arr))
                 self.processAllFiles=False
                 self.index+=1
+            elif(option=="a"):
+                self.append=True
+                self.index+=1
+            elif(option=="j"):
+                self.jobs=int(self.getopt(arr))
+                self.index+=1
             else:
                 print("Illegal option: "+option)
                 self.useage()
@@ -75,11 +83,15 @@ class CommandLineParser:
         print("   -r Start JD End JD [Default is all matching files]")
         print("   -h ASCII header file [Default 'header.[denum]' e.g. 'header.405']")
         print("   -o Output binary file [Default 'jpleph.[denum]]")
+        print("   -a Append to (or resume) an existing output file")
+        print("   -j Number of files converted in parallel, 0 for one per core [Default 1]")
         print()
         print("Examples:")
         print("   asc2bin.py 102")
         print("   asc2bin.py 431t -p \"c:\\asciifiles\\\" -o \"c:\\binfiles\\jpleph.431t\"")
         print("   asc2bin.py 405 -r 2451536.5 2458864.5")
+        print("   asc2bin.py 431t -j 8")
+        print("   asc2bin.py 405 -a -o jpleph.405")
         print()
         print("ASCII file names are assumed to match asc*.[denum] and are in the proper")
         print("order when sorted alphabetically (e.g. the original names from JPL).")
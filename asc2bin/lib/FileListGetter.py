@@ -1,41 +1,110 @@
 import glob
 import os
-import re
+import json
 
 class FileListGetter:
+    #JD ranges of the ASCII files are cached in this file, next to them
+    manifestName="asc2bin.manifest.json"
+
     def __init__(self,denum,path,useAll,startJD,endJD):
         self.files=[]
         self._loadFileList(denum,path,useAll,startJD,endJD)
 
     def _loadFileList(self,denum,path,useAll,startJD,endJD):
         if useAll:
-            self.files=glob.glob(os.path.join(path,"asc*."+denum))
-            self.files.sort()
+            self.ranges=self._getFileRanges(denum,path)
         else:
             self._getFilesForJDRange(denum,path,startJD,endJD)
+        self.files=[r[0] for r in self.ranges]
+        if(len(self.files)==0):
+            print("Error: no ASCII files found for asc*."+denum+" in '"+path+"' and the given range.")
+            exit()
 
-        firstJD=self._getStartJDForFile(self.files[0])
-        lastJD=self._getEndJDForFile(self.files[len(self.files)-1])
+        firstJD=self.ranges[0][1]
+        lastJD=self.ranges[len(self.ranges)-1][2]
         self.startJD=firstJD
         self.endJD=lastJD
         if(useAll==False):
-            if(firstJD>startJD):
-                self.startJD=firstJD
-            if(lastJD<endJD):
-                self.endJD=lastJD
+            self.startJD=max(firstJD,startJD)
+            self.endJD=min(lastJD,endJD)
 
     def _getFilesForJDRange(self,denum,path,startJD,endJD):
-        self.files=[]
-        allFiles=glob.glob(os.path.join(path,"asc*."+denum))
-        allFiles.sort()
+        #Files with a block starting in startJD..endJD
+        self.ranges=[r for r in self._getFileRanges(denum,path) if r[1]<=endJD and r[3]>=startJD]
+
+    def _getFileRanges(self,denum,path):
+        #(file, start JD, end JD, start JD of the last block) for every
+        #asc*.[denum] file, sorted by name.
+        #Files whose size and mtime match the manifest aren't opened, the
+        #others are read and the manifest updated.
+        manifestFile=os.path.join(path,self.manifestName)
+        manifest=FileListGetter._loadManifest(manifestFile)
+        changed=False
+
+        for name in list(manifest):
+            if(not os.path.exists(os.path.join(path,name))):
+                del manifest[name]
+                changed=True
+
+        ranges=[]
+        for f in sorted(glob.glob(os.path.join(path,"asc*."+denum))):
+            st=os.stat(f)
+            name=os.path.basename(f)
+            entry=manifest.get(name)
+            if(entry is None or entry["size"]!=st.st_size or entry["mtime"]!=st.st_mtime_ns):
+                entry=FileListGetter._getFileInfo(f,st)
+                manifest[name]=entry
+                changed=True
+            blockLength=(entry["endJD"]-entry["startJD"])/entry["blocks"]
+            ranges.append((f,entry["startJD"],entry["endJD"],entry["endJD"]-blockLength))
+
+        if(changed):
+            FileListGetter._saveManifest(manifestFile,manifest)
+        return ranges
+
+    @staticmethod
+    def _getFileInfo(filename,st):
+        f=open(filename,"r")
+        f.readline()
+        t=f.readline().split()
+        f.close()
+        startJD=float(t[0].replace("D","E"))
+        blockEndJD=float(t[1].replace("D","E"))
+        endJD=FileListGetter._getEndJDForFile(filename)
+        return {
+            "size":st.st_size,
+            "mtime":st.st_mtime_ns,
+            "startJD":startJD,
+            "endJD":endJD,
+            "blocks":round((endJD-startJD)/(blockEndJD-startJD))
+        }
+
+    @staticmethod
+    def _loadManifest(manifestFile):
+        try:
+            f=open(manifestFile,"r")
+            manifest=json.load(f)["files"]
+            f.close()
+            return manifest
+        except (OSError,ValueError,KeyError,TypeError):
+            return {}
 
-        for f in allFiles:
-            s=self._getStartJDForFile(f)
-            e=self._getEndJDForFile(f)
-            if(startJD>=s or endJD<=e):
-                self.files.append(f)
+    @staticmethod
+    def _saveManifest(manifestFile,manifest):
+        #Written to a temporary file and renamed, so an interrupted run never
+        #leaves a truncated manifest.  A read only directory just means no
+        #manifest.
+        try:
+            temp=manifestFile+".tmp"
+            f=open(temp,"w")
+            json.dump({"version":1,"files":manifest},f,indent=1,sort_keys=True)
+            f.close()
+            os.replace(temp,manifestFile)
+        except OSError:
+            pass
 
-    def _getEndJDForFile(self,filename):
+    @staticmethod
+    def _getEndJDForFile(filename):
         f=open(filename,"rb")
         if os.path.getsize(filename) > 100000:
             f.seek(-100000,2)
@@ -48,18 +117,19 @@ class FileListGetter:
 
             l=f.readline().decode("ascii").strip()
             if len(l)>0:
-                t=re.split("\s+",l)
+                t=l.split()
                 lastJD=float(t[1].replace("D","E"))
 
         f.close()
         return lastJD
 
-    def _getStartJDForFile(self,filename):
+    @staticmethod
+    def _getStartJDForFile(filename):
         f=open(filename,"r")
         l=f.readline()
 
         l=f.readline().strip()
-        t=re.split("\s+",l)
+        t=l.split()
         startJD=float(t[0].replace("D","E"))
 
         f.close()
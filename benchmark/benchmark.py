@@ -0,0 +1,285 @@
+#!/usr/bin/python
+
+# Speed benchmarks for the Python readers and asc2bin.
+#
+# Runs against the bundled "test data/jpleph2000-2040.405" and ASCII files
+# generated from it (DE405 format, written to a temporary directory), so the
+# numbers only depend on the code and the machine.  Epochs come from a fixed
+# seed, every measurement is the best of several repeats.
+#
+# Useage:
+# python benchmark.py [-o results.json] [--quick] [--only header,scalar,...]
+#
+# Sections: header, scalar, throughput, snapshot, ascii, asc2bin
+#
+# Results are printed and written as JSON, one entry per measurement with
+# its value and unit, plus the Python/NumPy versions and platform, so runs
+# can be compared over time (e.g. with --compare old.json).
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+
+root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,os.path.join(root,"asc2bin"))
+sys.path.insert(0,os.path.join(root,"ASCII","python"))
+sys.path.insert(0,os.path.join(root,"Binary","Python"))
+
+from JPLDE import *
+import de as asciide
+from lib import BinWriter
+
+testFile=os.path.join(root,"test data","jpleph2000-2040.405")
+headerFile=os.path.join(root,"utility","header.405")
+headersFile=os.path.join(root,"ASCII","allheaders.txt")
+
+class Benchmark:
+    def __init__(self,quick=False,seed=405):
+        self.quick=quick
+        self.seed=seed
+        self.results={}
+
+    def record(self,name,value,unit):
+        self.results[name]={"value":value,"unit":unit}
+        print(f"{name:<40} {value:14.3f} {unit}")
+
+    def timeCall(self,fn,number,repeat=5):
+        #Best (lowest) mean time per call over repeat runs of number calls
+        if(self.quick):
+            number=max(1,number//10)
+            repeat=min(repeat,3)
+        best=None
+        for r in range(repeat):
+            start=time.perf_counter()
+            for i in range(number):
+                fn()
+            t=(time.perf_counter()-start)/number
+            if(best is None or t<best):
+                best=t
+        return best
+
+    def getRandomJDs(self,de,count):
+        r=random.Random(self.seed)
+        return [r.uniform(de.jdStart,de.jdEnd) for i in range(count)]
+
+    def header(self):
+        self.record("header.parse",self.timeCall(lambda:JPLDEHeader(testFile),200)*1e6,"us")
+        self.record("header.load.cached",self.timeCall(lambda:JPLDEHeader.load(testFile),2000)*1e6,"us")
+
+        def coldOpen():
+            JPLDEHeader.cache.clear()
+            JPLDE(testFile).close()
+        self.record("open.cold",self.timeCall(coldOpen,200)*1e6,"us")
+        self.record("open.warm",self.timeCall(lambda:JPLDE(testFile).close(),200)*1e6,"us")
+
+    def scalar(self):
+        de=JPLDE(testFile)
+        jds=self.getRandomJDs(de,1000)
+        block=de.getBlockForJD(jds[0])
+        coefficients=list(block[3:17])
+        i=[0]
+        def nextJD():
+            i[0]=(i[0]+1)%len(jds)
+            return jds[i[0]]
+
+        self.record("getBlockForJD",self.timeCall(lambda:de.getBlockForJD(nextJD()),20000)*1e6,"us")
+        self.record("computePolynomial.14",self.timeCall(lambda:de.computePolynomial(0.3,coefficients),20000)*1e6,"us")
+        self.record("getPlanet.latency.mercury",self.timeCall(lambda:de.getPlanet(0,nextJD()),5000)*1e6,"us")
+        self.record("getPlanet.latency.moon",self.timeCall(lambda:de.getPlanet(9,nextJD()),5000)*1e6,"us")
+        self.record("getPlanet.latency.earth",self.timeCall(lambda:de.getPlanet(JPLDE.EARTH,nextJD()),5000)*1e6,"us")
+        self.record("relativeState.latency",self.timeCall(lambda:de.relativeState(10,3,nextJD()),5000)*1e6,"us")
+        de.enableStats()
+        self.record("getPlanet.latency.mercury.stats",self.timeCall(lambda:de.getPlanet(0,nextJD()),5000)*1e6,"us")
+        de.close()
+
+    def throughput(self):
+        de=JPLDE(testFile)
+        count=2000
+        sequential=[de.jdStart+i*0.1 for i in range(count)]
+        randomJDs=self.getRandomJDs(de,count)
+        def scalarRun(jds):
+            for jd in jds:
+                de.getPlanet(2,jd)
+        self.record("scalar.sequential",count/self.timeCall(lambda:scalarRun(sequential),1,3),"epochs/s")
+        self.record("scalar.random",count/self.timeCall(lambda:scalarRun(randomJDs),1,3),"epochs/s")
+
+        if(numpy is not None):
+            count=200000
+            sequential=numpy.linspace(de.jdStart,de.jdEnd,count)
+            randomJDs=numpy.random.default_rng(self.seed).uniform(de.jdStart,de.jdEnd,count)
+            bodies=list(range(11))
+            self.record("batch.sequential",count/self.timeCall(lambda:de.getStates([2],sequential),1,3),"epochs/s")
+            self.record("batch.random",count/self.timeCall(lambda:de.getStates([2],randomJDs),1,3),"epochs/s")
+            self.record("batch.random.11bodies",count*len(bodies)/self.timeCall(lambda:de.getStates(bodies,randomJDs),1,3),"states/s")
+        de.close()
+
+    def snapshot(self):
+        if(numpy is None):
+            return
+        de=JPLDE(testFile)
+        jds=self.getRandomJDs(de,1000)
+        i=[0]
+        def nextJD():
+            i[0]=(i[0]+1)%len(jds)
+            return jds[i[0]]
+        self.record("getAllBodies.latency",self.timeCall(lambda:de.getAllBodies(nextJD()),2000)*1e6,"us")
+        batch=numpy.array(jds)
+        self.record("getAllBodiesBatch",self.timeCall(lambda:de.getAllBodiesBatch(batch),5)/len(batch)*1e6,"us/epoch")
+        de.close()
+
+    def ascii(self,fixtures,jdRange):
+        row=getHeaderRow("405")
+        files=sorted(f for f in os.listdir(os.path.join(fixtures,"de405")) if f.startswith("asc") and not f.endswith(".f64"))
+        path=os.path.join(fixtures,"de405",files[0])
+        size=os.path.getsize(path)
+
+        parse=self.timeCall(lambda:asciide.DE.parseCoefficients(path),1,3)
+        self.record("ascii.parse",size/parse/1e6,"MB/s")
+        asciide.DE.saveCoefficientCache(path,asciide.DE.parseCoefficients(path))
+        self.record("ascii.sidecar.load",self.timeCall(lambda:asciide.DE.loadCoefficientCache(path),50)*1e3,"ms")
+
+        #DE() reads files relative to the working directory
+        cwd=os.getcwd()
+        os.chdir(fixtures)
+        try:
+            def loadFile():
+                d=asciide.DE(row)
+                d.loadFile(files[0])
+            def loadFileCold():
+                os.remove(path+".f64")
+                loadFile()
+            self.record("ascii.loadFile.cold",self.timeCall(loadFileCold,3)*1e3,"ms")
+            self.record("ascii.loadFile.sidecar",self.timeCall(loadFile,20)*1e3,"ms")
+
+            d=asciide.DE(row)
+            r=random.Random(self.seed)
+            jds=[r.uniform(jdRange[0],jdRange[1]) for i in range(1000)]
+            i=[0]
+            def nextJD():
+                i[0]=(i[0]+1)%len(jds)
+                return jds[i[0]]
+            self.record("ascii.getAllPropertiesForSeries",self.timeCall(lambda:d.getAllPropertiesForSeries(2,nextJD()),5000)*1e6,"us")
+        finally:
+            os.chdir(cwd)
+
+    def asc2bin(self,fixtures,jdRange):
+        asciiFiles=sorted(os.path.join(fixtures,"de405",f) for f in os.listdir(os.path.join(fixtures,"de405")) if f.startswith("asc") and not f.endswith(".f64"))
+        size=sum(os.path.getsize(f) for f in asciiFiles)
+        start,end=jdRange
+        output=os.path.join(fixtures,"jpleph.405")
+        for jobs in (1,2):
+            def convert():
+                with open(os.devnull,"w") as devnull, contextlib.redirect_stdout(devnull):
+                    BinWriter.FileWriter("405",headerFile,asciiFiles,output,start,end,jobs)
+            self.record(f"asc2bin.j{jobs}",size/self.timeCall(convert,1,3)/1e6,"MB/s")
+
+    def run(self,sections,fixtures,jdRange):
+        for s in sections:
+            if(s in ("ascii","asc2bin")):
+                getattr(self,s)(fixtures,jdRange)
+            else:
+                getattr(self,s)()
+
+    def getReport(self):
+        return {
+            "version":1,
+            "time":time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python":platform.python_version(),
+            "numpy":numpy.__version__ if numpy is not None else None,
+            "platform":platform.platform(),
+            "cpus":os.cpu_count(),
+            "quick":self.quick,
+            "seed":self.seed,
+            "results":self.results
+        }
+
+def getHeaderRow(denum):
+    #The row for denum from allheaders.txt, as used by ASCII/python/de.py
+    f=open(headersFile,"r")
+    for l in f:
+        l=l.strip()
+        if(l.startswith('[  "'+denum+'"')):
+            f.close()
+            return json.loads(l.rstrip(","))
+    f.close()
+    raise ValueError(f"DE{denum} not in {headersFile}")
+
+def formatD(x):
+    #Fortran D format as in JPL's ASCII files, e.g.  0.12345678901234567D+04
+    if(x==0):
+        return "  0.000000000000000000D+00"
+    s=f"{abs(x):.17E}"
+    exponent=int(s[20:])+1
+    return ("  " if x>=0 else " -")+"0."+s[0]+s[2:19]+"D"+f"{exponent:+03d}"
+
+def writeFixtures(directory,blocksPerFile=60,files=2):
+    #ASCII files copied from the binary test file, consecutive files
+    #overlapping by one block like JPL's.  Returns the JD range covered.
+    de=JPLDE(testFile)
+    os.makedirs(os.path.join(directory,"de405"),exist_ok=True)
+    ncoeff=de.blockSize//8
+    first=0
+    for n in range(files):
+        jd=de.getBlock(first)[0]
+        year=2000+int((jd-2451544.5)/365.25)
+        f=open(os.path.join(directory,"de405",f"ascp{year:04d}.405"),"w")
+        for i in range(blocksPerFile):
+            block=list(de.getBlock(first+i))+[0.0]*((-ncoeff)%3)
+            f.write(f"{i+1:6d}{ncoeff:6d}\n")
+            for c in range(0,len(block),3):
+                f.write("".join(formatD(v) for v in block[c:c+3])+"\n")
+        f.close()
+        first+=blocksPerFile-1
+    jdRange=(de.getBlock(0)[0],de.getBlock(first)[0])
+    de.close()
+    shutil.copy(headerFile,os.path.join(directory,"de405","header.405"))
+    return jdRange
+
+def compare(old,new):
+    #Ratio new/old for each measurement in both reports
+    print()
+    print(f"{'':<40} {'old':>14} {'new':>14}  ratio")
+    for name,r in new["results"].items():
+        o=old["results"].get(name)
+        if(o is None or o["unit"]!=r["unit"] or o["value"]==0):
+            continue
+        print(f"{name:<40} {o['value']:14.3f} {r['value']:14.3f}  {r['value']/o['value']:.2f} {r['unit']}")
+
+def main(argv):
+    sections=["header","scalar","throughput","snapshot","ascii","asc2bin"]
+    parser=argparse.ArgumentParser(description="Benchmarks the Python JPL DE readers and asc2bin.")
+    parser.add_argument("-o",dest="output",default="benchmark.json",help="JSON results file [Default benchmark.json]")
+    parser.add_argument("--quick",action="store_true",help="fewer repeats, for a quick check")
+    parser.add_argument("--only",default=",".join(sections),help="comma separated sections to run")
+    parser.add_argument("--seed",type=int,default=405,help="seed for the random epochs [Default 405]")
+    parser.add_argument("--compare",help="earlier JSON results to compare with")
+    args=parser.parse_args(argv)
+
+    bench=Benchmark(args.quick,args.seed)
+    fixtures=tempfile.mkdtemp(prefix="jplde-bench-")
+    try:
+        jdRange=writeFixtures(fixtures)
+        bench.run([s for s in args.only.split(",") if s in sections],fixtures,jdRange)
+    finally:
+        shutil.rmtree(fixtures,ignore_errors=True)
+
+    report=bench.getReport()
+    f=open(args.output,"w")
+    json.dump(report,f,indent=1)
+    f.close()
+    print(f"Results written to {args.output}")
+
+    if(args.compare is not None):
+        f=open(args.compare,"r")
+        compare(json.load(f),report)
+        f.close()
+
+if __name__=="__main__":
+    main(sys.argv[1:])